@@ -34,50 +34,270 @@ EXIT /B
 '''
 
 import base64
+import bisect
+import hashlib
+import io
+import json
+import os
 import py7zr
 import PySimpleGUI as sg
 import random
 import requests
 import soundfile
 import sounddevice
+import tempfile
 import threading
-from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "PlayClass")
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+DECODE_CACHE_SIZE = 256 * 1024 * 1024
+DECODE_DTYPE = "float64"
+BASE64_DELETE = bytes(set(range(256)) - set(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="))
+
+class Base64Decoder:
+	def __init__(self, out):
+		self._out = out
+		self._rest = b""
+
+	def write(self, chunk):
+		data = self._rest + chunk.translate(None, BASE64_DELETE)
+		end = len(data) - len(data) % 4
+		self._out.write(base64.b64decode(data[:end]))
+		self._rest = data[end:]
+
+	def flush(self):
+		if len(self._rest) > 0:
+			self._out.write(base64.b64decode(self._rest))
+			self._rest = b""
+
+class ConcatReader(io.RawIOBase):
+	def __init__(self, files):
+		self._files = files
+		self._offsets = [0]
+		for f in files:
+			f.seek(0, io.SEEK_END)
+			self._offsets.append(self._offsets[-1] + f.tell())
+		self._position = 0
+
+	def readable(self):
+		return True
+
+	def seekable(self):
+		return True
+
+	def tell(self):
+		return self._position
+
+	def seek(self, offset, whence=io.SEEK_SET):
+		if whence == io.SEEK_CUR:
+			offset += self._position
+		elif whence == io.SEEK_END:
+			offset += self._offsets[-1]
+		self._position = max(offset, 0)
+		return self._position
+
+	def readinto(self, buffer):
+		view = memoryview(buffer).cast("B")
+		size = 0
+		while size < len(view) and self._position < self._offsets[-1]:
+			i = bisect.bisect_right(self._offsets, self._position) - 1
+			f = self._files[i]
+			f.seek(self._position - self._offsets[i])
+			data = f.read(min(len(view) - size, self._offsets[i + 1] - self._position))
+			if len(data) == 0:
+				break
+			view[size:size + len(data)] = data
+			size += len(data)
+			self._position += len(data)
+		return size
+
+	def close(self):
+		for f in self._files:
+			f.close()
+		super().close()
 
 class PlayClass:
-	def __init__(self, window, bar_max):
+	def __init__(self, window, bar_max, cache_dir=CACHE_DIR, decode_cache_size=DECODE_CACHE_SIZE, dtype=DECODE_DTYPE):
 		self._bar_max = bar_max
+		self._cache_dir = cache_dir
+		self._decode_cache_size = decode_cache_size
+		self._dtype = dtype
 		self._is_mute = False
 		self._is_playing = False
 		self._is_repeat = False
 		self._datas = None
 		self._indexes = None
 		self._index = -1
+		self._current = None
 		self._stream = None
 		self._window = window
+		self._session = None
+		self._progress_lock = threading.Lock()
+		self._downloaded_size = 0
+		self._total_size = 0
+		self._decode_lock = threading.Lock()
+		self._decode_executor = ThreadPoolExecutor(max_workers=1)
+		self._decoded = OrderedDict()
+		self._decoded_size = 0
+		self._decoding = {}
+
+	def _getSession(self):
+		if self._session == None:
+			self._session = requests.Session()
+			adapter = requests.adapters.HTTPAdapter(pool_maxsize=DOWNLOAD_WORKERS)
+			self._session.mount("http://", adapter)
+			self._session.mount("https://", adapter)
+			self._session.headers.update({ "Accept-Encoding": "identity" })
+		return self._session
+
+	def _getCachePath(self, url):
+		name = hashlib.sha1(url.encode()).hexdigest()[:16] + "." + url.rstrip("/").split("/")[-1]
+		return os.path.join(self._cache_dir, name)
+
+	def _addProgress(self, size):
+		with self._progress_lock:
+			self._downloaded_size += size
+			self._window["Progress"].update(self._bar_max * self._downloaded_size / max(self._total_size, 1))
+
+	def _headPart(self, url):
+		res = self._getSession().head(url, allow_redirects=True)
+		res.raise_for_status()
+		return res.headers.get("ETag"), int(res.headers["Content-Length"])
+
+	def _downloadPart(self, url, etag, length):
+		path = self._getCachePath(url)
+		meta_path = path + ".json"
+		meta = { "etag": etag, "length": length }
+		size = os.path.getsize(path) if os.path.exists(path) else 0
+		if os.path.exists(meta_path):
+			with open(meta_path) as f:
+				if not json.load(f) == meta:
+					size = 0
+		else:
+			size = 0
+		if size > length:
+			size = 0
+		self._addProgress(size)
+		segment = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+		try:
+			decoder = Base64Decoder(segment)
+			if size == length:
+				self._decodeCache(path, size, decoder)
+			else:
+				self._downloadRest(url, etag, path, meta_path, meta, size, decoder)
+			decoder.flush()
+		except:
+			segment.close()
+			raise
+		return segment
+
+	def _decodeCache(self, path, size, decoder):
+		with open(path, "rb") as f:
+			while size > 0:
+				chunk = f.read(min(size, DOWNLOAD_CHUNK_SIZE))
+				if len(chunk) == 0:
+					break
+				decoder.write(chunk)
+				size -= len(chunk)
+
+	def _downloadRest(self, url, etag, path, meta_path, meta, size, decoder):
+		with open(meta_path, "w") as f:
+			json.dump(meta, f)
+		headers = {}
+		if size > 0:
+			headers["Range"] = "bytes={}-".format(size)
+			if not etag == None:
+				headers["If-Range"] = etag
+		with self._getSession().get(url, headers=headers, stream=True) as res:
+			res.raise_for_status()
+			if res.status_code == 206:
+				self._decodeCache(path, size, decoder)
+			else:
+				self._addProgress(-size)
+				size = 0
+			with open(path, "r+b" if size > 0 else "wb") as f:
+				f.seek(size)
+				f.truncate()
+				for chunk in res.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+					f.write(chunk)
+					decoder.write(chunk)
+					self._addProgress(len(chunk))
+		if not os.path.getsize(path) == meta["length"]:
+			raise IOError("incomplete download: {}".format(url))
 
 	def _getDatabase(self, urls):
-		headers = { "Accept-Encoding": "identity" }
-		total_size = sum([int(requests.head(url, headers=headers).headers["Content-Length"]) for url in urls])
-		texts = []
-		size = 0
-		for url in urls:
-			data = BytesIO()
-			with requests.get(url, stream=True) as res:
-				for chunk in res.iter_content(chunk_size=1024*1024):
-					data.write(chunk)
-					size += len(chunk)
-					self._window["Progress"].update(self._bar_max * size / total_size)
-			texts.append(data.getvalue().decode())
-		return texts
+		os.makedirs(self._cache_dir, exist_ok=True)
+		self._downloaded_size = 0
+		self._total_size = 0
+		with ThreadPoolExecutor(max_workers=min(DOWNLOAD_WORKERS, len(urls))) as executor:
+			heads = list(executor.map(self._headPart, urls))
+			self._total_size = sum([length for _, length in heads])
+			futures = [executor.submit(self._downloadPart, url, *head) for url, head in zip(urls, heads)]
+		segments = []
+		try:
+			for future in futures:
+				segments.append(future.result())
+		except:
+			for future in futures:
+				if future.exception() == None:
+					future.result().close()
+			raise
+		return segments
+
+	def _decodeTrack(self, datas, index):
+		try:
+			data, samplerate = soundfile.read(io.BytesIO(datas[index][1]), dtype=self._dtype)
+		except:
+			with self._decode_lock:
+				if datas is self._datas:
+					self._decoding.pop(index, None)
+			raise
+		with self._decode_lock:
+			if datas is self._datas:
+				self._decoding.pop(index, None)
+				self._decoded[index] = (data, samplerate)
+				self._decoded_size += data.nbytes
+				while self._decoded_size > self._decode_cache_size and len(self._decoded) > 1:
+					_, (old_data, _) = self._decoded.popitem(last=False)
+					self._decoded_size -= old_data.nbytes
+		return data, samplerate
+
+	def _requestTrack(self, index):
+		with self._decode_lock:
+			if index in self._decoded:
+				self._decoded.move_to_end(index)
+				future = Future()
+				future.set_result(self._decoded[index])
+				return future
+			if not index in self._decoding:
+				self._decoding[index] = self._decode_executor.submit(self._decodeTrack, self._datas, index)
+			return self._decoding[index]
+
+	def _setTracks(self, datas):
+		with self._decode_lock:
+			self._datas = datas
+			self._decoded = OrderedDict()
+			self._decoded_size = 0
+			self._decoding = {}
+		self._indexes = None
+		self._index = -1
+		self._current = None
 
 	def _updateIndex(self):
 		self._current_frame = 0
-		if not self._is_repeat:
+		if not self._is_repeat or self._current == None:
 			self._index += 1
 			if self._indexes == None or self._index >= len(self._datas):
 				self._indexes = [i for i in range(len(self._datas))]
 				random.shuffle(self._indexes)
 				self._index = 0
+			self._current = self._requestTrack(self._indexes[self._index]).result()
+			if self._index + 1 < len(self._indexes):
+				self._requestTrack(self._indexes[self._index + 1])
 			self._window["Slider"].Update(range=(0, len(self.getCurrentData()) / self._getCurrentSamplerate()))
 		self._window["Slider"].update(self._current_frame / self._getCurrentSamplerate())
 
@@ -86,13 +306,13 @@ class PlayClass:
 		self._window["Load"].Update(disabled=True)
 		urls = ["https://raw.githubusercontent.com/CID8705/utils/main/database.{:0>3}.txt".format(i) for i in range(1, database_num + 1)]
 		try:
-			stream = [base64.b64decode(text) for text in self._getDatabase(urls)]
-			with py7zr.SevenZipFile(BytesIO(b"".join(stream)), mode="r", password=password) as archive:
-				raw_data = archive.readall()
+			with ConcatReader(self._getDatabase(urls)) as stream:
+				with py7zr.SevenZipFile(stream, mode="r", password=password) as archive:
+					raw_data = archive.readall()
 		finally:
 			self._window["Load"].Update(disabled=False)
 		self.stopSound()
-		self._datas = [(key, *soundfile.read(value)) for key, value in raw_data.items()]
+		self._setTracks([(key, value.getvalue()) for key, value in raw_data.items()])
 		self._updateIndex()
 		self._window["Slider"].Update(disabled=False)
 		self._window["Play / Pause"].Update(disabled=False)
@@ -101,10 +321,10 @@ class PlayClass:
 		self._window["Mute"].Update(disabled=False)
 
 	def getCurrentData(self):
-		return self._datas[self._indexes[self._index]][1]
+		return self._current[0]
 
 	def _getCurrentSamplerate(self):
-		return self._datas[self._indexes[self._index]][2]
+		return self._current[1]
 
 	def setCurrentTime(self, current_time):
 		self._current_frame = int(current_time * self._getCurrentSamplerate())
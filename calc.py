@@ -1,5 +1,19 @@
+import contextlib
+import cProfile
+import hashlib
 import itertools
+import json
+import math
+import multiprocessing
+import os
+import pstats
+import shutil
+import struct
+import tempfile
+import time
 from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import numpy as np
 import copy # グラフをコピーするために使用
 
 # LSB (右端) からのビット位置を返すヘルパー関数
@@ -123,79 +137,487 @@ def build_euler_graph_variable_s(N, S):
 
     return mutable_edges, total_s_transitions, start_node
 
+# =========================================================================
+# 整数ビットマスク表現によるグラフ構築
+# 状態は int、パスは各状態を Nビットずつ詰めた int (先頭の状態が上位ビット) で表す。
+# 文字列への変換は出力時のみ行う。
+# =========================================================================
+
+def format_state_int(N, state):
+    """整数状態を Nビットの文字列 ('0101' 形式) に変換する"""
+    return format(state, f'0{N}b')
+
+def unpack_path_int(N, length, packed_path):
+    """詰められたパス (length 個の状態) を状態の整数リストに展開する"""
+    state_mask = (1 << N) - 1
+    return [(packed_path >> (N * (length - 1 - i))) & state_mask for i in range(length)]
+
+def format_path_int(N, length, packed_path):
+    """詰められたパスを 'A->B->...' 形式の文字列に変換する"""
+    return "->".join(format_state_int(N, s) for s in unpack_path_int(N, length, packed_path))
+
+def get_bit_change_key_int(N, length, packed_path):
+    """
+    詰められたパスのビット変化パターンを整数キーとして返す。
+    各ステップを (LSBインデックス * 2 + 変化後のビット値) とし、先頭のステップを上位に詰める。
+    get_bit_change_sequence と1対1に対応する (単一ビット変化のパスのみを対象とする)。
+    """
+    code_bits = (2 * N - 1).bit_length()
+    states = unpack_path_int(N, length, packed_path)
+    key = 0
+    for state_a, state_b in zip(states, states[1:]):
+        k = (state_a ^ state_b).bit_length() - 1
+        key = (key << code_bits) | (k << 1) | ((state_b >> k) & 1)
+    return key
+
+def format_bit_change_key_int(N, S, key):
+    """整数のビット変化パターンキーを get_bit_change_sequence と同じ文字列形式に変換する"""
+    code_bits = (2 * N - 1).bit_length()
+    code_mask = (1 << code_bits) - 1
+    change_sequence = []
+    for i in range(S):
+        code = (key >> (code_bits * (S - 1 - i))) & code_mask
+        k, bit_b = code >> 1, code & 1
+        change_sequence.append(f"{k}:{1 - bit_b}->{bit_b}")
+    return "->".join(change_sequence)
+
+def build_euler_graph_variable_s_bitmask(N, S):
+    """
+    build_euler_graph_variable_s の整数ビットマスク版。
+    ノード (S個の状態からなるパス) と遷移 (S+1個の状態からなるパス) を詰めた int で表し、
+    隣接状態は state ^ (1 << k) で求める。辺の順序は文字列版と同一。
+    """
+    if S < 1:
+        raise ValueError("ステップ数 S は 1 以上である必要があります。")
+
+    num_states = 1 << N
+    node_mask = (1 << (N * S)) - 1
+    state_mask = num_states - 1
+    # 各状態の隣接状態 (文字列版と同じ昇順)
+    neighbors = [sorted(s ^ (1 << k) for k in range(N)) for s in range(num_states)]
+
+    # S個の状態からなるパス (ノード) を辞書順に生成
+    start_paths = list(range(num_states))
+    for _ in range(S - 1):
+        start_paths = [(p << N) | t for p in start_paths for t in neighbors[p & state_mask]]
+
+    mutable_edges = defaultdict(deque)
+    total_s_transitions = 0
+    for p in start_paths:
+        edges = mutable_edges[p]
+        for t in neighbors[p & state_mask]:
+            transition = (p << N) | t
+            edges.append((transition & node_mask, transition))
+        total_s_transitions += len(edges)
+
+    start_node = start_paths[0] if total_s_transitions > 0 else None
+    return mutable_edges, total_s_transitions, start_node
+
+def group_edges_by_pattern(N, S, mutable_edges):
+    """
+    ビット変化パターンによる辺のグループ化。
+    戻り値: ({パターンキー: [(始点, 終点, 遷移), ...]}, 全ノードの集合)
+    """
+    pattern_to_edges_map = defaultdict(list)
+    all_nodes = set()
+    
+    for start_node, edges_deque in mutable_edges.items():
+        all_nodes.add(start_node)
+        for end_node, transition in edges_deque: 
+            all_nodes.add(end_node)
+            
+            bit_change_key = get_bit_change_key_int(N, S + 1, transition)
+            
+            # 候補辺として全ての情報をリストに格納
+            pattern_to_edges_map[bit_change_key].append((start_node, end_node, transition))
+
+    return pattern_to_edges_map, all_nodes
+
+# =========================================================================
+# 構築済みグラフのディスクキャッシュ
+# (N, S, 形式バージョン) ごとに辺の配列とパターンのグループ化を .npy で保存し、
+# 次回以降はメモリマップで読み込む。サイズ上限を超えたら最も古く使われたものから削除する。
+# =========================================================================
+
+GRAPH_CACHE_DIR = "./calc_graph_cache"
+GRAPH_CACHE_FORMAT_VERSION = 1
+GRAPH_CACHE_MAX_BYTES = 1 << 30
+_GRAPH_CACHE_ARRAYS = ("sources", "targets", "transitions", "pattern_keys", "pattern_offsets", "pattern_edges")
+
+def graph_cache_key(N, S):
+    """(N, S, 形式バージョン) から決まるキャッシュエントリ名"""
+    return hashlib.sha256(f"euler-graph:{N}:{S}:{GRAPH_CACHE_FORMAT_VERSION}".encode()).hexdigest()
+
+def build_graph_arrays(N, S):
+    """
+    完全グラフとパターンのグループ化を NumPy 配列に変換する。
+    戻り値: (配列の辞書, メタ情報の辞書)
+      sources/targets/transitions: 辺ごとの始点・終点・遷移 (構築順)
+      pattern_keys: パターンキー (初出順)
+      pattern_offsets/pattern_edges: パターン p の候補辺の番号は pattern_edges[pattern_offsets[p]:pattern_offsets[p+1]]
+    """
+    if N * (S + 1) > 64:
+        raise ValueError(f"N*(S+1)={N * (S + 1)} ビットの遷移は 64 ビット配列に格納できません。")
+
+    mutable_edges, total_count, start_node = build_euler_graph_variable_s_bitmask(N, S)
+    sources = np.empty(total_count, dtype=np.uint64)
+    targets = np.empty(total_count, dtype=np.uint64)
+    transitions = np.empty(total_count, dtype=np.uint64)
+    edge_patterns = np.empty(total_count, dtype=np.int64)
+    pattern_ids = {}
+    i = 0
+    for start, edges_deque in mutable_edges.items():
+        for end, transition in edges_deque:
+            sources[i], targets[i], transitions[i] = start, end, transition
+            edge_patterns[i] = pattern_ids.setdefault(get_bit_change_key_int(N, S + 1, transition), len(pattern_ids))
+            i += 1
+
+    arrays = {
+        "sources": sources,
+        "targets": targets,
+        "transitions": transitions,
+        "pattern_keys": np.fromiter(pattern_ids, dtype=np.uint64, count=len(pattern_ids)),
+        "pattern_offsets": np.concatenate(([0], np.cumsum(np.bincount(edge_patterns, minlength=len(pattern_ids))))).astype(np.int64),
+        # 安定ソートにより、各パターン内の候補辺は構築順のまま並ぶ
+        "pattern_edges": np.argsort(edge_patterns, kind="stable").astype(np.int64),
+    }
+    meta = {"N": N, "S": S, "version": GRAPH_CACHE_FORMAT_VERSION, "total": total_count, "start_node": start_node}
+    return arrays, meta
+
+def _graph_cache_entry_size(entry_dir):
+    return sum(entry.stat().st_size for entry in os.scandir(entry_dir) if entry.is_file())
+
+def evict_graph_cache(cache_dir, max_bytes=GRAPH_CACHE_MAX_BYTES, keep=None):
+    """キャッシュの合計サイズが max_bytes 以下になるまで、最も古く使われたエントリから削除する (keep は残す)"""
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_dir() and not entry.name.startswith("."):
+            entries.append((entry.stat().st_mtime, entry.path, _graph_cache_entry_size(entry.path)))
+    total_size = sum(size for _, _, size in entries)
+    for _, path, size in sorted(entries):
+        if total_size <= max_bytes:
+            break
+        if keep is not None and os.path.basename(path) == keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total_size -= size
+
+def load_graph_arrays(N, S, cache_dir=GRAPH_CACHE_DIR, max_bytes=GRAPH_CACHE_MAX_BYTES):
+    """
+    キャッシュから (配列の辞書, メタ情報の辞書) を読み込む (配列は読み取り専用のメモリマップ)。
+    キャッシュに無ければ build_graph_arrays で構築して保存する。
+    """
+    key = graph_cache_key(N, S)
+    entry_dir = os.path.join(cache_dir, key)
+    meta_path = os.path.join(entry_dir, "meta.json")
+
+    if not os.path.exists(meta_path):
+        arrays, meta = build_graph_arrays(N, S)
+        os.makedirs(cache_dir, exist_ok=True)
+        # 一時ディレクトリに書き出してから rename し、書きかけのエントリを読ませない
+        temp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=cache_dir)
+        try:
+            for name in _GRAPH_CACHE_ARRAYS:
+                np.save(os.path.join(temp_dir, f"{name}.npy"), arrays[name])
+            with open(os.path.join(temp_dir, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            # 他のプロセスが先に同じエントリを作成した場合はそちらを使う
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            if not os.path.exists(meta_path):
+                raise
+        evict_graph_cache(cache_dir, max_bytes, keep=key)
+
+    with open(meta_path, encoding="utf-8") as f:
+        meta = json.load(f)
+    arrays = {name: np.load(os.path.join(entry_dir, f"{name}.npy"), mmap_mode="r") for name in _GRAPH_CACHE_ARRAYS}
+    # 最終使用時刻を更新 (LRU 削除の基準)
+    os.utime(entry_dir)
+    return arrays, meta
+
+def group_edges_from_arrays(arrays):
+    """
+    build_graph_arrays / load_graph_arrays の配列から、group_edges_by_pattern と同じ形式の
+    ({パターンキー: [(始点, 終点, 遷移), ...]}, 全ノードの集合) を復元する。
+    """
+    sources = arrays["sources"].tolist()
+    targets = arrays["targets"].tolist()
+    transitions = arrays["transitions"].tolist()
+    offsets = arrays["pattern_offsets"].tolist()
+    pattern_edges = arrays["pattern_edges"].tolist()
+    pattern_to_edges_map = {}
+    for p, key in enumerate(arrays["pattern_keys"].tolist()):
+        pattern_to_edges_map[key] = [(sources[i], targets[i], transitions[i])
+                                     for i in pattern_edges[offsets[p]:offsets[p + 1]]]
+    # 全てのノードは出辺を持つ
+    all_nodes = set(sources)
+    return pattern_to_edges_map, all_nodes
+
+# =========================================================================
+# CSR (圧縮行格納) 形式の配列ベースのグラフ表現
+# ノードは一度だけ番号付けし (node_keys[i] が番号 i のノードの詰めた int)、
+# 辺は offsets / 終点番号 / パターン番号の配列で表す (1辺あたり 8〜12 バイト)。
+# =========================================================================
+
+def _index_dtype(size):
+    """size 個の要素を指す番号を格納できる最小の整数型"""
+    return np.int32 if size < (1 << 31) else np.int64
+
+class CSRGraph:
+    """
+    ノード i の出辺は targets[offsets[i]:offsets[i+1]]、辺 e のパターン番号は edge_patterns[e]。
+    パターン p の候補辺の番号は pattern_edges[pattern_offsets[p]:pattern_offsets[p+1]] (昇順)。
+    """
+    def __init__(self, N, S, node_keys, offsets, targets, edge_patterns, pattern_keys, pattern_offsets, pattern_edges):
+        self.N = N
+        self.S = S
+        self.node_keys = node_keys
+        self.offsets = offsets
+        self.targets = targets
+        self.edge_patterns = edge_patterns
+        self.pattern_keys = pattern_keys
+        self.pattern_offsets = pattern_offsets
+        self.pattern_edges = pattern_edges
+
+    @property
+    def num_nodes(self):
+        return len(self.node_keys)
+
+    @property
+    def num_edges(self):
+        return len(self.targets)
+
+    @property
+    def num_patterns(self):
+        return len(self.pattern_keys)
+
+    def edge_sources(self, edges):
+        """辺番号 (配列) の始点番号を返す"""
+        return np.searchsorted(self.offsets, edges, side="right") - 1
+
+    def pattern_candidates(self, p):
+        """パターン p の候補辺の番号 (昇順)"""
+        return self.pattern_edges[self.pattern_offsets[p]:self.pattern_offsets[p + 1]]
+
+    def to_packed_edge(self, u, v, e):
+        """(始点番号, 終点番号, 辺番号) を詰めた int の (始点, 終点, 遷移) に変換する"""
+        start, end = int(self.node_keys[u]), int(self.node_keys[v])
+        return start, end, (start << self.N) | (end & ((1 << self.N) - 1))
+
+    @classmethod
+    def from_graph_arrays(cls, arrays, meta):
+        """build_graph_arrays / load_graph_arrays の配列から構築する"""
+        N, S = meta["N"], meta["S"]
+        sources, targets = arrays["sources"], arrays["targets"]
+        # 辺は始点の昇順に並んでいる
+        node_keys = np.unique(sources)
+        index_dtype = _index_dtype(len(sources))
+        offsets = np.searchsorted(sources, node_keys).astype(np.int64)
+        offsets = np.append(offsets, np.int64(len(sources)))
+        pattern_offsets = np.asarray(arrays["pattern_offsets"], dtype=np.int64)
+        pattern_edges = np.asarray(arrays["pattern_edges"]).astype(index_dtype)
+        edge_patterns = np.empty(len(sources), dtype=_index_dtype(len(pattern_offsets)))
+        edge_patterns[pattern_edges] = np.repeat(np.arange(len(pattern_offsets) - 1), np.diff(pattern_offsets))
+        return cls(N, S, node_keys, offsets, np.searchsorted(node_keys, targets).astype(_index_dtype(len(node_keys))),
+                   edge_patterns, np.asarray(arrays["pattern_keys"]), pattern_offsets, pattern_edges)
+
+def build_csr_graph(N, S):
+    """
+    build_euler_graph_variable_s_bitmask と同じグラフ (同じ辺の順序・パターンの初出順) を
+    Python のループを使わずに CSRGraph として構築する。
+    """
+    if S < 1:
+        raise ValueError("ステップ数 S は 1 以上である必要があります。")
+    if N * (S + 1) > 64:
+        raise ValueError(f"N*(S+1)={N * (S + 1)} ビットの遷移は 64 ビット配列に格納できません。")
+
+    shift = np.uint64(N)
+    state_mask = np.uint64((1 << N) - 1)
+    node_mask = np.uint64((1 << (N * S)) - 1)
+    states = np.arange(1 << N, dtype=np.uint64)
+    # 各状態の隣接状態 (昇順)
+    neighbors = np.sort(states[:, None] ^ (np.uint64(1) << np.arange(N, dtype=np.uint64))[None, :], axis=1)
+
+    # S個の状態からなるパス (ノード)。辞書順に生成されるため node_keys は昇順に並ぶ
+    node_keys = states
+    for _ in range(S - 1):
+        node_keys = ((node_keys[:, None] << shift) | neighbors[(node_keys & state_mask).astype(np.intp)]).ravel()
+    transitions = ((node_keys[:, None] << shift) | neighbors[(node_keys & state_mask).astype(np.intp)]).ravel()
+
+    num_nodes, num_edges = len(node_keys), len(transitions)
+    offsets = np.arange(num_nodes + 1, dtype=np.int64) * N
+    targets = np.searchsorted(node_keys, transitions & node_mask).astype(_index_dtype(num_nodes))
+
+    # ビット変化パターンキー (get_bit_change_key_int と同じ値) をまとめて計算する
+    code_bits = np.uint64((2 * N - 1).bit_length())
+    keys = np.zeros(num_edges, dtype=np.uint64)
+    for i in range(S):
+        state_a = (transitions >> np.uint64(N * (S - i))) & state_mask
+        state_b = (transitions >> np.uint64(N * (S - 1 - i))) & state_mask
+        # 差分は2のべき乗なので、log2 は正確に求まる
+        k = np.log2((state_a ^ state_b).astype(np.float64)).astype(np.uint64)
+        keys = (keys << code_bits) | (k << np.uint64(1)) | ((state_b >> k) & np.uint64(1))
+    del transitions
+
+    return CSRGraph(N, S, node_keys, offsets, targets, *_group_edge_keys(keys))
+
+def _group_edge_keys(keys):
+    """
+    辺ごとのパターンキーからパターンのグループ化を求める (パターン番号は初出順に振る)。
+    戻り値: (辺ごとのパターン番号, パターンキー, pattern_offsets, pattern_edges)
+    """
+    unique_keys, first_index, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(first_index, kind="stable")
+    rank = np.empty(len(order), dtype=_index_dtype(len(order)))
+    rank[order] = np.arange(len(order))
+    edge_patterns = rank[inverse.ravel()]
+    pattern_offsets = np.concatenate(([0], np.cumsum(np.bincount(edge_patterns, minlength=len(order))))).astype(np.int64)
+    pattern_edges = np.argsort(edge_patterns, kind="stable").astype(_index_dtype(len(keys)))
+    return edge_patterns, unique_keys[order], pattern_offsets, pattern_edges
+
+def extend_csr_graph(graph):
+    """
+    S ステップの CSRGraph から S+1 ステップの CSRGraph (build_csr_graph(N, S+1) と同一) を導く。
+    S+1 のグラフは S のグラフの線グラフ (S の辺がノード、連続する2辺の組が辺) であり、
+    S+1 の辺のパターンキーは、先頭の辺のパターンキーに後続の辺の最後のステップを連結したものとなる。
+    """
+    N, S = graph.N, graph.S
+    if N * (S + 2) > 64:
+        raise ValueError(f"N*(S+2)={N * (S + 2)} ビットの遷移は 64 ビット配列に格納できません。")
+
+    shift = np.uint64(N)
+    code_bits = np.uint64((2 * N - 1).bit_length())
+    code_mask = (np.uint64(1) << code_bits) - np.uint64(1)
+    num_edges = graph.num_edges
+    edge_sources = np.repeat(np.arange(graph.num_nodes), np.diff(graph.offsets))
+    # S の遷移 (構築順に昇順) が S+1 のノード
+    node_keys = (graph.node_keys[edge_sources] << shift) | (graph.node_keys[graph.targets] & np.uint64((1 << N) - 1))
+    del edge_sources
+
+    # S+1 のノード e (S の辺 e) の出辺は、e の終点から出る S の辺 f と1対1に対応する
+    out_degree = np.diff(graph.offsets)[graph.targets]
+    offsets = np.concatenate(([0], np.cumsum(out_degree))).astype(np.int64)
+    num_new_edges = int(offsets[-1])
+    first = np.repeat(np.arange(num_edges), out_degree)
+    following = np.repeat(graph.offsets[:-1][graph.targets] - offsets[:-1], out_degree) + np.arange(num_new_edges)
+    targets = following.astype(_index_dtype(num_edges))
+
+    edge_keys = graph.pattern_keys[graph.edge_patterns]
+    keys = (edge_keys[first] << code_bits) | (edge_keys[following] & code_mask)
+    del first, following, edge_keys
+    return CSRGraph(N, S + 1, node_keys, offsets, targets, *_group_edge_keys(keys))
+
+def iter_csr_graph_levels(N, max_S, min_S=1):
+    """
+    S = min_S, ..., max_S の CSRGraph を順に返すジェネレータ。
+    min_S のグラフのみを構築し、以降は直前のグラフから extend_csr_graph で導く。
+    """
+    graph = build_csr_graph(N, min_S)
+    yield graph
+    for _ in range(min_S, max_S):
+        graph = extend_csr_graph(graph)
+        yield graph
+
+def _is_closed_walk(circuit, start_node):
+    """辺のリストが start_node から出て start_node に戻る一続きの経路か (次数が釣り合っていないグラフでは途切れる)"""
+    if not circuit:
+        return True
+    return (circuit[0][0] == start_node and circuit[-1][1] == start_node
+            and all(prev[1] == edge[0] for prev, edge in zip(circuit, itertools.islice(circuit, 1, None))))
+
+def _find_euler_circuit_csr(graph, start_node):
+    """find_euler_circuit の CSRGraph 版。cursor[u] がノード u の次の未使用辺の番号"""
+    total_edges = graph.num_edges
+    if not 0 <= start_node < graph.num_nodes or graph.offsets[start_node] == graph.offsets[start_node + 1]:
+        return [], total_edges == 0
+
+    cursor = graph.offsets[:-1].copy()
+    cursor_view = memoryview(cursor)
+    ends = memoryview(graph.offsets)[1:]
+    targets = memoryview(np.ascontiguousarray(graph.targets))
+    # スタックの各要素: (ノード番号, そのノードに入った辺 (u, v, 辺番号))
+    stack = [(start_node, None)]
+    circuit = []
+    while stack:
+        u, in_edge = stack[-1]
+        e = cursor_view[u]
+        if e < ends[u]:
+            cursor_view[u] = e + 1
+            v = targets[e]
+            stack.append((v, (u, v, e)))
+        else:
+            stack.pop()
+            if in_edge is not None:
+                circuit.append(in_edge)
+
+    circuit.reverse()
+    return circuit, len(circuit) == total_edges and _is_closed_walk(circuit, start_node)
+
 # =========================================================================
 # 階層的ディクショナリを用いたオイラー閉路探索（ヒエホルツァーのアルゴリズム）
 # =========================================================================
 def find_euler_circuit(graph, start_node):
     """
-    Hierholzerのアルゴリズムを使用してオイラー閉路を探索する。
+    Hierholzerのアルゴリズムを使用してオイラー閉路を探索する (O(E))。
     graphは defaultdict(deque) 形式: {始点: deque([(終点, 辺のデータ), ...]), ...}
+    グラフはコピーも変更もせず、ノードごとのカーソル (イテレータ) で未使用の辺を取り出す。
+    戻り値: (閉路の辺のリスト [(u, v, 辺のデータ), ...], 全ての辺を使い切ったオイラー閉路か)
+    全ノードで入次数 = 出次数であることが前提で、満たさない場合は辺のリストが一続きにならないため False を返す。
+    graph に CSRGraph を渡した場合、ノードはノード番号、辺のデータは辺番号となる。
     """
-    # 探索に使用するため、グラフをコピーして非破壊的に処理する
-    temp_graph = {k: deque(v) for k, v in graph.items()}
-    
-    current_path = [start_node]
+    if isinstance(graph, CSRGraph):
+        return _find_euler_circuit_csr(graph, start_node)
+
+    total_edges = sum(len(adjacent) for adjacent in graph.values())
+
+    # グラフが空、または開始ノードに辺がない場合は終了
+    if start_node not in graph or not graph[start_node]:
+        return [], total_edges == 0
+
+    # ノードごとのカーソル (訪問したノードについてのみ作成する)
+    cursors = {}
+    # スタックの各要素: (ノード, そのノードに入った辺 (u, v, 辺のデータ))
+    stack = [(start_node, None)]
     circuit = []
-    
-    # グラフが空または開始ノードに辺がない場合は終了
-    if not temp_graph or start_node not in temp_graph and any(temp_graph.values()):
-        return []
 
-    while current_path:
-        u = current_path[-1]
-        
-        if u in temp_graph and temp_graph[u]:
-            v, edge_data = temp_graph[u].popleft()
-            current_path.append(v)
-            circuit.append((u, v, edge_data))
+    while stack:
+        u, in_edge = stack[-1]
+        cursor = cursors.get(u)
+        if cursor is None:
+            cursor = cursors[u] = iter(graph.get(u, ()))
+        next_edge = next(cursor, None)
+        if next_edge is not None:
+            v, edge_data = next_edge
+            stack.append((v, (u, v, edge_data)))
         else:
-            # 閉路を抽出してメインの閉路に組み込む
-            # u (最後のノード) が含まれる閉路セグメントを抽出
-            closed_segment = []
-            
-            # current_pathから閉路を構成するノードを取り出す
-            segment_start_node = None
-            if len(current_path) > 1:
-                # 最後のノード u が出次数0の場合、uが閉路の終点
-                segment_end_node = current_path.pop() 
-                # segment_end_node に繋がる最後の辺 (u_prev, u) を探す
-                
-                for i in range(len(circuit) - 1, -1, -1):
-                    u_prev, v, edge_data = circuit[i]
-                    if v == segment_end_node:
-                        # 閉路のセグメントの始点が見つかった
-                        segment_start_node = u_prev
-                        # 閉路セグメントを circuit から切り離す
-                        closed_segment = circuit[i:] 
-                        circuit = circuit[:i]
-                        break
-                        
-                # 閉路セグメントを circuit に戻す
-                circuit.extend(closed_segment)
-                
-                # 次の探索を開始するノード (出次数 > 0 のノード) を見つける
-                while current_path:
-                    check_node = current_path[-1]
-                    if check_node in temp_graph and temp_graph[check_node]:
-                        break
-                    current_path.pop()
-                    
-            elif len(current_path) == 1 and not (u in temp_graph and temp_graph[u]):
-                # グラフ全体が辺を使い切ったか、開始ノードで止まった
-                break
+            # 行き止まり: スタックを巻き戻しながら閉路に辺を追加する (逆順)
+            stack.pop()
+            if in_edge is not None:
+                circuit.append(in_edge)
 
-    # 最終チェック: 全ての辺が使用されたか確認 (オイラー閉路の必須条件)
-    # ただし、Hierholzerのアルゴリズムの簡略化バージョンでは、部分閉路しか見つけられない場合もあるため、
-    # ここでは見つかった閉路の辺数のみをチェックする。
-    
-    # 閉路の辺のリスト (u, v, edge_data) を返す
-    return circuit
+    circuit.reverse()
+    return circuit, len(circuit) == total_edges and _is_closed_walk(circuit, start_node)
 
 def is_eulerian(edges, total_edges, all_nodes):
     """
     グラフがオイラーグラフの条件を満たすかチェックする。
     （辺の総数が一致し、全ノードで入次数=出次数、かつ強連結）
+    edges に CSRGraph を渡した場合は、グラフの全ノードについて配列演算でチェックする (all_nodes は不要)。
     """
+    if isinstance(edges, CSRGraph):
+        if edges.num_edges != total_edges:
+            return False, "辺の総数が不一致"
+        out_degree = np.diff(edges.offsets)
+        in_degree = np.bincount(edges.targets, minlength=edges.num_nodes)
+        unbalanced = np.flatnonzero(in_degree != out_degree)
+        if len(unbalanced):
+            node = int(unbalanced[0])
+            return False, f"ノード {node} で入次数({in_degree[node]}) != 出次数({out_degree[node]})"
+        return True, ""
+
     in_degree = defaultdict(int)
     out_degree = defaultdict(int)
     
@@ -213,102 +635,1055 @@ def is_eulerian(edges, total_edges, all_nodes):
             return False, f"ノード {node} で入次数({in_degree[node]}) != 出次数({out_degree[node]})"
             
     # 3. 強連結性の確認は、オイラー閉路探索（find_euler_circuit）に任せる
-    # （find_euler_circuit が全ての辺を使い切れば強連結性も満たされる）
+    # （次数が釣り合ったグラフで find_euler_circuit が全ての辺を使い切れば強連結性も満たされる）
+    return True, ""
+
+
+# =========================================================================
+# BEST 定理によるオイラー閉路の存在判定と数え上げ (探索を行わない)
+# ec(G) = t_w(G) * Π_v (出次数(v) - 1)!  (t_w は根 w の有向全域木の数 = 縮約ラプラシアンの行列式)
+# =========================================================================
+
+# 剰余での行列式に使う素数の上限 (積が int64 に収まるように 2^31 未満とする)
+_DETERMINANT_PRIME_LIMIT = 1 << 31
+
+def _is_prime(n):
+    """決定的 Miller-Rabin (n < 3.3 * 10^24 で正確)"""
+    if n < 2:
+        return False
+    for p in (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41):
+        if n % p == 0:
+            return n == p
+    d, r = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        r += 1
+    for a in (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41):
+        x = pow(a, d, n)
+        if x in (1, n - 1):
+            continue
+        for _ in range(r - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+def _determinant_primes():
+    """2^31 未満の素数を大きい順に生成する"""
+    n = _DETERMINANT_PRIME_LIMIT - 1
+    while n > 2:
+        if _is_prime(n):
+            yield n
+        n -= 2
+
+def determinant_mod(matrix, modulus):
+    """整数行列の行列式を素数 modulus (< 2^31) を法として求める (NumPy によるガウスの消去法、O(n^3))"""
+    if not 1 < modulus < _DETERMINANT_PRIME_LIMIT:
+        raise ValueError(f"modulus は 2^31 未満の素数である必要があります: {modulus}")
+    a = np.array(matrix, dtype=np.int64) % modulus
+    n = len(a)
+    det = 1
+    for col in range(n):
+        nonzero = np.flatnonzero(a[col:, col])
+        if len(nonzero) == 0:
+            return 0
+        pivot = col + int(nonzero[0])
+        if pivot != col:
+            a[[col, pivot]] = a[[pivot, col]]
+            det = -det
+        pivot_value = int(a[col, col])
+        det = det * pivot_value % modulus
+        factors = a[col + 1:, col] * pow(pivot_value, -1, modulus) % modulus
+        a[col + 1:, col:] = (a[col + 1:, col:] - factors[:, None] * a[col, col:] % modulus) % modulus
+    return det % modulus
+
+def determinant_exact(matrix):
+    """
+    整数行列の行列式を多倍長整数で正確に求める。
+    アダマールの不等式による上界を超えるまで複数の素数で determinant_mod を求め、中国剰余定理で復元する。
+    """
+    a = np.array(matrix, dtype=np.int64)
+    if len(a) == 0:
+        return 1
+    row_norms = np.sum(a.astype(np.float64) ** 2, axis=1)
+    if np.any(row_norms == 0):
+        return 0
+    # |det| <= Π ||行||。符号の分と余裕を加えたビット数
+    bound_bits = int(np.ceil(0.5 * np.sum(np.log2(row_norms)))) + 2
+    value, product = 0, 1
+    for prime in _determinant_primes():
+        residue = determinant_mod(a, prime)
+        value += product * ((residue - value) * pow(product % prime, -1, prime) % prime)
+        product *= prime
+        if product.bit_length() > bound_bits:
+            break
+    # 対称な剰余 (負の行列式) に直す
+    return value - product if value > product // 2 else value
+
+def _edge_endpoints(edges):
+    """辺のリスト [(u, v, 辺のデータ), ...] または CSRGraph から (始点のリスト, 終点のリスト) を返す"""
+    if isinstance(edges, CSRGraph):
+        return edges.edge_sources(np.arange(edges.num_edges)).tolist(), edges.targets.tolist()
+    return [u for u, _, _ in edges], [v for _, v, _ in edges]
+
+def _is_weakly_connected(sources, targets):
+    """辺を持つノードが (向きを無視して) 連結か"""
+    parent = {}
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+    for u, v in zip(sources, targets):
+        parent.setdefault(u, u)
+        parent.setdefault(v, v)
+        root_u, root_v = find(u), find(v)
+        if root_u != root_v:
+            parent[root_u] = root_v
+    return len({find(x) for x in parent}) <= 1
+
+def has_euler_circuit(edges, all_nodes=None):
+    """
+    選択された辺 (または CSRGraph) がオイラー閉路を持つか (入次数 = 出次数、かつ辺を持つノードが連結)。
+    戻り値: (bool, 理由)
+    """
+    sources, targets = _edge_endpoints(edges)
+    if not sources:
+        return False, "辺がありません"
+    if all_nodes is None:
+        all_nodes = set(sources) | set(targets)
+    total_edges = edges.num_edges if isinstance(edges, CSRGraph) else len(edges)
+    is_balanced, reason = is_eulerian(edges, total_edges, all_nodes)
+    if not is_balanced:
+        return False, reason
+    if not _is_weakly_connected(sources, targets):
+        return False, "辺を持つノードが連結ではありません"
     return True, ""
 
+def count_euler_circuits(edges, all_nodes=None, modulus=None):
+    """
+    選択された辺 (または CSRGraph) のオイラー閉路の数を BEST 定理で求める (探索は行わない)。
+    辺は区別し、巡回シフトで一致する閉路は同一とみなす (開始辺を固定した閉路の数)。
+    modulus (2^31 未満の素数) を指定すると、その剰余を返す (大きなグラフで高速)。
+    戻り値: (閉路の数, 理由)。閉路が存在しなければ (0, 理由)。
+    """
+    exists, reason = has_euler_circuit(edges, all_nodes)
+    if not exists:
+        return 0, reason
+
+    sources, targets = _edge_endpoints(edges)
+    node_index = {}
+    for x in itertools.chain(sources, targets):
+        node_index.setdefault(x, len(node_index))
+    source_ids = np.fromiter((node_index[u] for u in sources), dtype=np.intp, count=len(sources))
+    target_ids = np.fromiter((node_index[v] for v in targets), dtype=np.intp, count=len(targets))
+    n = len(node_index)
+
+    # ラプラシアン L = D_out - A (多重辺は本数だけ数える)
+    out_degree = np.bincount(source_ids, minlength=n)
+    laplacian = np.diag(out_degree).astype(np.int64)
+    np.add.at(laplacian, (source_ids, target_ids), -1)
+    # 根 (番号 0 のノード) の行と列を除いた行列式 = 根付き有向全域木の数
+    reduced = laplacian[1:, 1:]
+
+    if modulus is None:
+        count = determinant_exact(reduced)
+        for degree in out_degree.tolist():
+            count *= math.factorial(degree - 1)
+    else:
+        count = determinant_mod(reduced, modulus)
+        for degree in out_degree.tolist():
+            for k in range(2, degree):
+                count = count * k % modulus
+    return count, ""
 
 # =========================================================================
-# 【修正箇所】バックトラックによる探索関数を追加
+# 超立方体の対称性 (ビットの置換と XOR による平行移動) による探索の枝刈り
 # =========================================================================
 
+# 閉路がないと分かった部分的な選択の標準形を記録する深さの上限と、記録数の上限
+SYMMETRY_MEMO_DEPTH = 8
+SYMMETRY_MEMO_MAX_ENTRIES = 1 << 18
+
+class HypercubeSymmetry:
+    """
+    N ビットの超立方体の自己同型 x -> π(x) ^ m のうち、開始ノードを固定するものの群。
+    各要素は状態の置換表 (長さ 2^N のタプル) で表す。
+    自己同型はビット変化パターンをパターンに、オイラー閉路をオイラー閉路に写すため、
+    探索ではそれまでの選択を固定する部分群の軌道ごとに1つの候補だけを試せばよい。
+    """
+    def __init__(self, N, S, start_node):
+        self.N = N
+        self.S = S
+        self.state_mask = (1 << N) - 1
+        start_states = unpack_path_int(N, S, start_node)
+        states = np.arange(1 << N, dtype=np.int64)
+        self.group = []
+        for permutation in itertools.permutations(range(N)):
+            table = np.zeros(1 << N, dtype=np.int64)
+            for k, image in enumerate(permutation):
+                table |= ((states >> k) & 1) << image
+            # 平行移動の成分は開始ノードの先頭の状態が固定されることから決まる
+            table ^= int(table[start_states[0]]) ^ start_states[0]
+            if all(int(table[x]) == x for x in start_states):
+                self.group.append(tuple(table.tolist()))
+
+    @property
+    def identity(self):
+        return tuple(range(1 << self.N))
+
+    def apply(self, element, length, packed_path):
+        """詰められたパス (length 個の状態) に群の要素を作用させる"""
+        N, state_mask = self.N, self.state_mask
+        result = 0
+        for shift in range(N * (length - 1), -1, -N):
+            result = (result << N) | element[(packed_path >> shift) & state_mask]
+        return result
+
+    def pattern_set_stabilizer(self, pattern_keys, representatives):
+        """
+        群のうち、パターンの集合を保つ要素 (探索するパターンが一部だけの場合に制限する)。
+        representatives: 各パターンの代表の遷移 (S+1個の状態からなるパス)
+        """
+        key_set = set(pattern_keys)
+        length = self.S + 1
+        return [element for element in self.group
+                if all(get_bit_change_key_int(self.N, length, self.apply(element, length, t)) in key_set
+                       for t in representatives)]
+
+    def stabilizer(self, group, transition):
+        """group のうち遷移 transition を固定する要素"""
+        length = self.S + 1
+        return [element for element in group if self.apply(element, length, transition) == transition]
+
+    def pattern_stabilizer(self, group, transition):
+        """group のうち transition のビット変化パターンを固定する要素"""
+        length = self.S + 1
+        key = get_bit_change_key_int(self.N, length, transition)
+        return [element for element in group
+                if get_bit_change_key_int(self.N, length, self.apply(element, length, transition)) == key]
+
+    def orbit_representatives(self, group, transitions):
+        """transitions の位置のうち、group の軌道ごとに最初に現れるものを元の順序で返す"""
+        length = self.S + 1
+        seen = set()
+        result = []
+        for index, transition in enumerate(transitions):
+            if transition in seen:
+                continue
+            result.append(index)
+            seen.update(self.apply(element, length, transition) for element in group)
+        return result
+
+    def canonical_selection(self, group, transitions):
+        """部分的な選択 (遷移の集合) の標準形。group で移り合う選択は同じ標準形になる"""
+        length = self.S + 1
+        return min(tuple(sorted(self.apply(element, length, t) for t in transitions)) for element in group)
+
+# =========================================================================
+# 探索の計測 (カウンタ・フェーズごとの実行時間・進捗の報告・プロファイル)
+# =========================================================================
+
+class SearchStats:
+    """
+    バックトラック探索の計測値。PatternSearch.search などに渡すと探索中に更新される。
+    coverage は探索木のうち探索済みの割合の推定値 (各深さの候補を等しい重みとみなした和で、探索し尽くすと 1)。
+    progress_callback(stats) は、前回の報告から progress_interval 秒以上経っていれば展開ノード 1024 個ごとに呼ばれる。
+    profile=True の場合は phase() の区間を cProfile で計測する。
+    """
+    def __init__(self, progress_callback=None, progress_interval=1.0, profile=False):
+        self.expanded_nodes = 0
+        self.tried_candidates = 0
+        self.pruned_candidates = 0
+        self.symmetry_skips = 0
+        # 深さ (選択済みのパターン数) ごとのバックトラックの回数
+        self.backtracks = defaultdict(int)
+        self.leaf_checks = 0
+        # 葉での閉路チェックの失敗理由ごとの回数
+        self.leaf_failures = defaultdict(int)
+        self.coverage = 0.0
+        self.phase_seconds = {}
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
+        self.profiler = cProfile.Profile() if profile else None
+        self.start_time = time.perf_counter()
+        self._last_report = self.start_time
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.start_time
+
+    def record_leaf(self, reason):
+        """葉 (全パターン選択済み) での閉路チェックの結果を記録する (reason が None なら成功)"""
+        self.leaf_checks += 1
+        if reason is not None:
+            self.leaf_failures[reason] += 1
+
+    def maybe_report(self, force=False):
+        """前回の報告から progress_interval 秒以上経っていれば (force なら常に) progress_callback を呼ぶ"""
+        now = time.perf_counter()
+        if self.progress_callback is not None and (force or now - self._last_report >= self.progress_interval):
+            self._last_report = now
+            self.progress_callback(self)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """with stats.phase(名前): の区間の実行時間を phase_seconds[名前] に加算する"""
+        if self.profiler is not None:
+            self.profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.phase_seconds[name] = self.phase_seconds.get(name, 0.0) + time.perf_counter() - start
+            if self.profiler is not None:
+                self.profiler.disable()
+
+    def counters(self):
+        """プロセス間で受け渡して merge できるカウンタの辞書"""
+        return {
+            "expanded_nodes": self.expanded_nodes,
+            "tried_candidates": self.tried_candidates,
+            "pruned_candidates": self.pruned_candidates,
+            "symmetry_skips": self.symmetry_skips,
+            "backtracks": dict(self.backtracks),
+            "leaf_checks": self.leaf_checks,
+            "leaf_failures": dict(self.leaf_failures),
+        }
+
+    def merge(self, counters):
+        """counters() の結果 (並列探索のワーカーの計測値) を加算する"""
+        for name in ("expanded_nodes", "tried_candidates", "pruned_candidates", "symmetry_skips", "leaf_checks"):
+            setattr(self, name, getattr(self, name) + counters[name])
+        for depth, count in counters["backtracks"].items():
+            self.backtracks[depth] += count
+        for reason, count in counters["leaf_failures"].items():
+            self.leaf_failures[reason] += count
+
+    def profile_stats(self, sort="cumulative"):
+        """cProfile の結果 (pstats.Stats)。profile=False の場合は None"""
+        if self.profiler is None:
+            return None
+        return pstats.Stats(self.profiler).sort_stats(sort)
+
+    def summary(self):
+        """計測結果を表示用の複数行の文字列にする"""
+        rate = self.expanded_nodes / max(self.elapsed, 1e-9)
+        coverage = "不明" if self.coverage is None else f"{self.coverage:.2%}"
+        lines = [
+            f"展開ノード数: {self.expanded_nodes} ({rate:.0f} ノード/秒)",
+            f"試した候補: {self.tried_candidates} (枝刈り: {self.pruned_candidates}, 対称性による省略: {self.symmetry_skips})",
+            f"葉での閉路チェック: {self.leaf_checks} (失敗: {sum(self.leaf_failures.values())})",
+            f"探索済みの割合 (推定): {coverage}",
+        ]
+        for reason, count in sorted(self.leaf_failures.items(), key=lambda item: -item[1]):
+            lines.append(f"  失敗理由 {reason}: {count}")
+        if self.backtracks:
+            lines.append("深さごとのバックトラック: " + ", ".join(
+                f"{depth}:{count}" for depth, count in sorted(self.backtracks.items())))
+        for name, seconds in self.phase_seconds.items():
+            lines.append(f"フェーズ {name}: {seconds:.3f} 秒")
+        return "\n".join(lines)
+
+def print_search_progress(stats):
+    """progress_callback の既定の実装: 進捗を1行で表示する"""
+    coverage = "不明" if stats.coverage is None else f"{stats.coverage:.4%}"
+    print(f"  ... {stats.elapsed:.1f} 秒: 展開 {stats.expanded_nodes} ノード, 葉 {stats.leaf_checks}, "
+          f"探索済み (推定) {coverage}", flush=True)
+
+# =========================================================================
+# バックトラックによる探索 (次数・連結成分の差分管理による枝刈り)
+# =========================================================================
+
+class PatternSearch:
+    """
+    各パターンから代表辺を1本ずつ選択するバックトラック探索の状態。
+    選択済みの辺による各ノードの (出次数 - 入次数) と、未選択パターンが各ノードに
+    供給できる入辺/出辺の数を差分更新し、釣り合いが取れなくなった時点で枝刈りする。
+    連結性はロールバック可能な Union-Find で管理する。
+    symmetry (HypercubeSymmetry) を指定すると、選択済みの辺を固定する対称性の軌道ごとに
+    1つの候補だけを試す (見つかる閉路は指定しない場合と同一)。
+    """
+    def __init__(self, patterns_list, pattern_to_edges_map, all_nodes, start_node, symmetry=None):
+        self.patterns_list = list(patterns_list)
+        self.all_nodes = all_nodes
+        self.start_node = start_node
+        self._init_candidates(pattern_to_edges_map)
+        self.symmetry = symmetry
+        # 選択済みの辺の遷移 (symmetry を指定した場合のみ記録する)
+        self.selected_transitions = []
+        # 選択の各深さで、それまでの選択を固定する対称性の部分群 (先頭はパターンの集合を保つ部分群)
+        self.symmetry_groups = [None]
+        if symmetry is not None:
+            self.symmetry_groups[0] = symmetry.pattern_set_stabilizer(
+                [self._pattern_key(p) for p in range(len(self.patterns_list))],
+                [self._packed_transition(edges[0]) for edges in self.candidates])
+        self.remaining = set(range(len(self.patterns_list)))
+        self.total_imbalance = 0
+        self.parent = {}
+        self.size = {}
+        self.components = 0
+        # 選択履歴: (パターン番号, 辺, 取り消し用の情報)
+        self.selected = []
+
+    def _init_candidates(self, pattern_to_edges_map):
+        self.candidates = [pattern_to_edges_map[key] for key in self.patterns_list]
+        # パターンごとの候補辺の始点/終点の集合
+        self.sources = [frozenset(u for u, _, _ in edges) for edges in self.candidates]
+        self.targets = [frozenset(v for _, v, _ in edges) for edges in self.candidates]
+        # 未選択パターンのうち、各ノードへの出辺/入辺を候補に持つものの数
+        self.out_capacity = defaultdict(int)
+        self.in_capacity = defaultdict(int)
+        for p in range(len(self.patterns_list)):
+            self._add_capacity(p, 1)
+        # 選択済みの辺による (出次数 - 入次数) と、その絶対値の総和
+        self.balance = defaultdict(int)
+        # 選択済みの辺が接続する本数 (0 のノードは Union-Find に含めない)
+        self.degree = defaultdict(int)
+
+    def _pattern_key(self, p):
+        return self.patterns_list[p]
+
+    def _packed_transition(self, edge):
+        return edge[2]
+
+    def _add_capacity(self, p, delta):
+        for x in self.sources[p]:
+            self.out_capacity[x] += delta
+        for x in self.targets[p]:
+            self.in_capacity[x] += delta
+
+    def _are_suppliers_balanceable(self, p):
+        # 供給可能数が減ったノードのみを再チェックする
+        for x in self.sources[p]:
+            if self.balance[x] < 0 and not self._is_node_balanceable(x):
+                return False
+        for x in self.targets[p]:
+            if self.balance[x] > 0 and not self._is_node_balanceable(x):
+                return False
+        return True
+
+    def _find(self, x):
+        # ロールバックのため経路圧縮は行わない (サイズによる併合で O(log V))
+        while self.parent[x] != x:
+            x = self.parent[x]
+        return x
+
+    def _touch(self, x, new_nodes):
+        if self.degree[x] == 0:
+            self.parent[x] = x
+            self.size[x] = 1
+            self.components += 1
+            new_nodes.append(x)
+        self.degree[x] += 1
+
+    def _add_balance(self, x, delta):
+        before = self.balance[x]
+        self.balance[x] = before + delta
+        self.total_imbalance += abs(before + delta) - abs(before)
+
+    def assign(self, p, edge):
+        """パターン p の代表辺として edge = (u, v, 辺のデータ) を選択する"""
+        u, v, _ = edge
+        self.remaining.remove(p)
+        self._add_capacity(p, -1)
+        self._add_balance(u, 1)
+        self._add_balance(v, -1)
+
+        new_nodes = []
+        self._touch(u, new_nodes)
+        self._touch(v, new_nodes)
+        root_u, root_v = self._find(u), self._find(v)
+        merged = None
+        if root_u != root_v:
+            if self.size[root_u] < self.size[root_v]:
+                root_u, root_v = root_v, root_u
+            self.parent[root_v] = root_u
+            self.size[root_u] += self.size[root_v]
+            self.components -= 1
+            merged = (root_v, root_u)
+        self.selected.append((p, edge, new_nodes, merged))
+        group = self.symmetry_groups[-1]
+        if group is not None:
+            transition = self._packed_transition(edge)
+            self.selected_transitions.append(transition)
+            if len(group) > 1:
+                group = self.symmetry.stabilizer(group, transition)
+        self.symmetry_groups.append(group)
+
+    def unassign(self):
+        """直前の選択を取り消す"""
+        p, (u, v, _), new_nodes, merged = self.selected.pop()
+        if self.symmetry_groups.pop() is not None:
+            self.selected_transitions.pop()
+        if merged is not None:
+            child, root = merged
+            self.parent[child] = child
+            self.size[root] -= self.size[child]
+            self.components += 1
+        self.degree[u] -= 1
+        self.degree[v] -= 1
+        for x in new_nodes:
+            del self.parent[x]
+            del self.size[x]
+            self.components -= 1
+        self._add_balance(u, -1)
+        self._add_balance(v, 1)
+        self._add_capacity(p, 1)
+        self.remaining.add(p)
+
+    def _is_node_balanceable(self, x):
+        b = self.balance[x]
+        if b > 0:
+            return b <= self.in_capacity[x]
+        return -b <= self.out_capacity[x]
+
+    def is_feasible(self):
+        """直前の選択の後も、残りのパターンで釣り合い・連結性を満たせる可能性があるか"""
+        remaining_count = len(self.remaining)
+        # 1本の辺で解消できる不均衡は最大 2
+        if self.total_imbalance > 2 * remaining_count:
+            return False
+        # 1本の辺で減らせる連結成分の数は最大 1
+        if self.components - remaining_count > 1:
+            return False
+        if self.degree[self.start_node] == 0 and self.out_capacity[self.start_node] == 0:
+            return False
+        if not self.selected:
+            return True
+        p, (u, v, _), _, _ = self.selected[-1]
+        if not (self._is_node_balanceable(u) and self._is_node_balanceable(v)):
+            return False
+        return self._are_suppliers_balanceable(p)
+
+    def feasible_candidates(self, p):
+        """パターン p の候補辺のうち、選択直後の次数条件を満たすものの位置を元の順序で返す"""
+        allowed_imbalance = 2 * (len(self.remaining) - 1)
+        targets, sources = self.targets[p], self.sources[p]
+        result = []
+        for index, (u, v, _) in enumerate(self.candidates[p]):
+            bu = self.balance[u] + 1
+            bv = self.balance[v] - 1
+            if bu > 0 and bu > self.in_capacity[u] - (u in targets):
+                continue
+            if bu < 0 and -bu > self.out_capacity[u] - 1:
+                continue
+            if bv < 0 and -bv > self.out_capacity[v] - (v in sources):
+                continue
+            if bv > 0 and bv > self.in_capacity[v] - 1:
+                continue
+            delta = abs(bu) - abs(bu - 1) + abs(bv) - abs(bv + 1)
+            if self.total_imbalance + delta > allowed_imbalance:
+                continue
+            result.append(index)
+        return result
+
+    def search_candidates(self, p):
+        """
+        探索で試すパターン p の候補の位置。feasible_candidates のうち、選択済みの辺と
+        パターン p を固定する対称性で移り合うものは最初の1つだけを残す。
+        """
+        indexes = self.feasible_candidates(p)
+        group = self.symmetry_groups[-1]
+        if group is None or len(group) <= 1 or len(indexes) <= 1:
+            return indexes
+        candidates = self.candidates[p]
+        group = self.symmetry.pattern_stabilizer(group, self._packed_transition(candidates[indexes[0]]))
+        transitions = [self._packed_transition(candidates[index]) for index in indexes]
+        return [indexes[i] for i in self.symmetry.orbit_representatives(group, transitions)]
+
+    def canonical_selection(self):
+        """現在の選択の対称性による標準形 (symmetry を指定しない場合は選択そのもの)"""
+        if self.symmetry is None:
+            return tuple(sorted(self._packed_transition(edge) for _, edge, _, _ in self.selected))
+        return self.symmetry.canonical_selection(self.symmetry_groups[0], self.selected_transitions)
+
+    def _memo_selection(self):
+        """現在の選択が標準形を記録する深さなら、その標準形を返す (対象外なら None)"""
+        if self.symmetry is None or len(self.symmetry_groups[0]) <= 1 or len(self.selected) > SYMMETRY_MEMO_DEPTH:
+            return None
+        return self.canonical_selection()
+
+    def pattern_order(self):
+        """未選択のパターンを、候補辺の少ないもの (最も制約の強いもの) から順に並べる"""
+        return sorted(self.remaining, key=lambda p: (len(self.candidates[p]), p))
+
+    def leaf_failure_reason(self):
+        """全パターンの選択後、閉路にならない理由 (釣り合い・連結性を満たせば None)"""
+        if self.total_imbalance != 0:
+            return "次数の不均衡"
+        if self.components != 1:
+            return "非連結"
+        if self.degree[self.start_node] == 0:
+            return "開始ノードを含まない"
+        return None
+
+    def build_circuit(self, stats=None):
+        """全パターンの選択後、釣り合い・連結性を確認してオイラー閉路を返す (満たさなければ None)"""
+        reason = self.leaf_failure_reason()
+        euler_circuit = None
+        if reason is None:
+            selected_edges = defaultdict(deque)
+            for _, (u, v, edge_data), _, _ in self.selected:
+                selected_edges[u].append((v, edge_data))
+            euler_circuit, is_complete = find_euler_circuit(selected_edges, self.start_node)
+            if not is_complete:
+                reason, euler_circuit = "閉路が完成しない", None
+        if stats is not None:
+            stats.record_leaf(reason)
+        return euler_circuit
+
+    def assign_prefix(self, prefix):
+        """選択済みプレフィックス [(パターン番号, 候補の位置), ...] を適用する。途中で枝刈りされれば取り消して False を返す"""
+        for p, index in prefix:
+            self.assign(p, self.candidates[p][index])
+            if not self.is_feasible():
+                self.reset()
+                return False
+        return True
+
+    def reset(self):
+        """全ての選択を取り消す"""
+        while self.selected:
+            self.unassign()
+
+    def _selected_prefix(self):
+        return [(p, self.candidates[p].index(edge)) for p, edge, _, _ in self.selected]
+
+    def search(self, skip=0, node_limit=None, cancel_event=None, stats=None):
+        """
+        明示的なスタックによる DFS (パターン数が再帰上限を超えても動作する)。
+        skip: 最初に選択するパターンで読み飛ばす候補の数 (分割されたサブツリーの再開用)
+        node_limit: 展開するノード数の上限。超えた場合は未探索の部分を分割して返す
+        cancel_event: セットされたら探索を打ち切る (並列探索の協調キャンセル用)
+        stats: SearchStats を渡すと、カウンタと探索済みの割合 (このサブツリーに対する推定値) を更新する
+        戻り値: (オイラー閉路 or None, 未探索のサブツリーのリスト [(選択済みプレフィックス, skip), ...])
+        """
+        order = self.pattern_order()
+        if not order:
+            return self.build_circuit(stats), []
+        base_depth = len(self.selected)
+        expanded_nodes = 0
+        # 閉路がないと分かった選択の標準形 (対称性で移り合う選択の下も同様に閉路がない)
+        refuted_selections = set()
+        # スタックの各要素: [パターン番号, 候補の位置のリスト, 次に試す候補, 選択中か, 候補1つあたりの重み]
+        # 重みは探索済みの割合の推定用 (各フレームの候補の重みの和が親の候補1つの重みになる)
+        root_indexes = self.search_candidates(order[0])
+        stack = [[order[0], root_indexes, skip, False, 1.0 / max(len(root_indexes) - skip, 1)]]
+        while stack:
+            frame = stack[-1]
+            p, candidate_indexes, i, is_assigned, weight = frame
+            if is_assigned:
+                # バックトラック: このパターンの前回の選択を元に戻す
+                self.unassign()
+                frame[3] = False
+                if stats is not None:
+                    stats.backtracks[len(self.selected)] += 1
+            while i < len(candidate_indexes):
+                self.assign(p, self.candidates[p][candidate_indexes[i]])
+                i += 1
+                if self.is_feasible():
+                    frame[3] = True
+                    break
+                self.unassign()
+                if stats is not None:
+                    stats.pruned_candidates += 1
+                    stats.coverage += weight
+            if stats is not None:
+                stats.tried_candidates += i - frame[2]
+            frame[2] = i
+            if not frame[3]:
+                stack.pop()
+                if stats is not None and not candidate_indexes:
+                    stats.coverage += weight
+                if stack:
+                    selection = self._memo_selection()
+                    if selection is not None and len(refuted_selections) < SYMMETRY_MEMO_MAX_ENTRIES:
+                        refuted_selections.add(selection)
+                continue
+            if not self.remaining:
+                euler_circuit = self.build_circuit(stats)
+                if stats is not None:
+                    stats.coverage += weight
+                if euler_circuit is not None:
+                    return euler_circuit, []
+                continue
+            selection = self._memo_selection()
+            if selection is not None and selection in refuted_selections:
+                if stats is not None:
+                    stats.symmetry_skips += 1
+                    stats.coverage += weight
+                continue
+
+            expanded_nodes += 1
+            if stats is not None:
+                stats.expanded_nodes += 1
+            if expanded_nodes % 1024 == 0:
+                if cancel_event is not None and cancel_event.is_set():
+                    return None, []
+                if stats is not None:
+                    stats.maybe_report()
+            if node_limit is not None and expanded_nodes >= node_limit:
+                # 上限に達した: 各深さの未試行の候補と、現在の選択の下のサブツリーを分割して返す
+                prefix = self._selected_prefix()
+                pending = [(prefix[:base_depth + depth], frame[2])
+                           for depth, frame in enumerate(stack) if frame[2] < len(frame[1])]
+                pending.append((prefix, 0))
+                return None, pending
+            p = order[len(stack)]
+            candidate_indexes = self.search_candidates(p)
+            stack.append([p, candidate_indexes, 0, False, weight / max(len(candidate_indexes), 1)])
+        return None, []
+
+
+class CSRPatternSearch(PatternSearch):
+    """
+    CSRGraph 上の PatternSearch。patterns_list はパターン番号、ノードはノード番号で扱う。
+    探索中の参照は1候補ごとの小さな演算なので、NumPy のスカラーや小さな配列は使わず、
+    候補辺は構築時に int のタプルのリストへ、次数・供給可能数はノード番号で引くリストへ変換して
+    PatternSearch の処理をそのまま使う。
+    """
+    def __init__(self, graph, patterns_list, start_node, symmetry=None):
+        self.graph = graph
+        super().__init__(patterns_list, graph, None, start_node, symmetry)
+
+    def _init_candidates(self, graph):
+        self.candidates = []
+        self.sources = []
+        self.targets = []
+        for pattern_id in self.patterns_list:
+            edges = graph.pattern_candidates(pattern_id)
+            candidate_sources = graph.edge_sources(edges).tolist()
+            candidate_targets = graph.targets[edges].tolist()
+            self.candidates.append(list(zip(candidate_sources, candidate_targets, edges.tolist())))
+            self.sources.append(frozenset(candidate_sources))
+            self.targets.append(frozenset(candidate_targets))
+        num_nodes = graph.num_nodes
+        self.out_capacity = [0] * num_nodes
+        self.in_capacity = [0] * num_nodes
+        for p in range(len(self.patterns_list)):
+            self._add_capacity(p, 1)
+        self.balance = [0] * num_nodes
+        self.degree = [0] * num_nodes
+
+    def _pattern_key(self, p):
+        return int(self.graph.pattern_keys[self.patterns_list[p]])
+
+    def _packed_transition(self, edge):
+        return self.graph.to_packed_edge(*edge)[2]
+
+def make_pattern_search(patterns_list, pattern_to_edges_map, all_nodes, start_node, symmetry=None):
+    """pattern_to_edges_map が CSRGraph なら CSRPatternSearch、それ以外は PatternSearch を作る"""
+    if isinstance(pattern_to_edges_map, CSRGraph):
+        return CSRPatternSearch(pattern_to_edges_map, patterns_list, start_node, symmetry)
+    return PatternSearch(patterns_list, pattern_to_edges_map, all_nodes, start_node, symmetry)
+
+
 def find_euler_circuit_by_search(patterns_list, pattern_to_edges_map, all_nodes, 
-                                 current_selection_index, current_euler_edges, total_unique_patterns, start_node_initial):
+                                 current_selection_index, current_euler_edges, total_unique_patterns, start_node_initial,
+                                 symmetry=None, stats=None):
     """
-    再帰的なDFSによるバックトラック探索。
+    枝刈り付きのバックトラック探索。
     patterns_list の各パターンに対し、辺の候補から一つを選択し、オイラー閉路をチェックする。
+    patterns_list[:current_selection_index] には current_euler_edges の辺が選択済みとして扱われる。
+    pattern_to_edges_map に CSRGraph を渡した場合、patterns_list はパターン番号、
+    start_node_initial はノード番号とし、閉路の辺は (始点番号, 終点番号, 辺番号) となる。
+    symmetry (HypercubeSymmetry) を指定すると、対称性で移り合う候補辺の探索を省略する。
+    stats (SearchStats) を指定すると、探索の計測値を記録する。
     """
-    # 終了条件: 全てのユニークパターンについて辺の選択が完了した
-    if current_selection_index == total_unique_patterns:
-        
-        # 4. 採用された辺でオイラー閉路を探索
-        # defaultdict(deque) に変換
-        final_euler_edges = defaultdict(deque)
-        total_edges_adopted = 0
-        for u, v, edge_data in current_euler_edges:
-            final_euler_edges[u].append((v, edge_data))
-            total_edges_adopted += 1
-            
-        # オイラー閉路の探索実行
-        euler_circuit = find_euler_circuit(final_euler_edges, start_node_initial)
-        
-        # 辺の総数がユニークパターン数と一致し、閉路がその長さと一致するか
-        if len(euler_circuit) == total_edges_adopted:
-            # 成功: オイラー閉路が見つかった
-            return euler_circuit
-        else:
-            # 失敗: 接続性が失われ、閉路が形成できなかった
-            return None 
+    search = make_pattern_search(patterns_list[:total_unique_patterns], pattern_to_edges_map, all_nodes, start_node_initial,
+                                 symmetry)
+    for p, edge in enumerate(current_euler_edges[:current_selection_index]):
+        search.assign(p, edge)
+        if not search.is_feasible():
+            return None
+    euler_circuit, _ = search.search(stats=stats)
+    return euler_circuit
 
-    # 探索対象のパターンキー
-    pattern_key = patterns_list[current_selection_index]
-    # そのパターンに該当する全ての辺の候補リスト [(start_node_str, end_node_str, transition_str), ...]
-    candidate_edges = pattern_to_edges_map[pattern_key]
+# =========================================================================
+# プロセスプールによる並列探索
+# =========================================================================
 
-    # 各候補辺について試行
-    for u, v, transition_str in candidate_edges:
-        
-        # 選択した辺を一時的にグラフに追加
-        current_euler_edges.append((u, v, transition_str))
-        
-        # 次のパターンへ再帰
-        result_circuit = find_euler_circuit_by_search(patterns_list, pattern_to_edges_map, all_nodes, 
-                                                     current_selection_index + 1, current_euler_edges, 
-                                                     total_unique_patterns, start_node_initial)
-        
-        if result_circuit is not None:
-            # 閉路が見つかった
-            return result_circuit
-            
-        # バックトラック: 辺の選択を元に戻す
-        current_euler_edges.pop()
+# 1タスクで展開するノード数の上限 (超えたら未探索部分を分割して再投入する)
+PARALLEL_SPLIT_NODE_LIMIT = 20000
+# 初期分割で作るタスク数の目安 (ワーカー数に対する倍率)
+PARALLEL_TASKS_PER_WORKER = 4
+
+# ワーカープロセスごとの探索状態 (initializer で一度だけ構築する)
+_worker_search = None
+_worker_cancel_event = None
+
+def _init_search_worker(patterns_list, pattern_to_edges_map, all_nodes, start_node, cancel_event, symmetry=None):
+    global _worker_search, _worker_cancel_event
+    _worker_search = make_pattern_search(patterns_list, pattern_to_edges_map, all_nodes, start_node, symmetry)
+    _worker_cancel_event = cancel_event
+
+def _search_subtree(prefix, skip, node_limit, collect_stats=False):
+    """
+    ワーカープロセスで1つのサブツリーを探索する。
+    戻り値: (オイラー閉路 or None, 未探索のサブツリーのリスト, collect_stats なら SearchStats.counters() の辞書)
+    """
+    stats = SearchStats() if collect_stats else None
+    if _worker_cancel_event.is_set() or not _worker_search.assign_prefix(prefix):
+        return None, [], stats and stats.counters()
+    try:
+        euler_circuit, subtrees = _worker_search.search(skip, node_limit, _worker_cancel_event, stats)
+        return euler_circuit, subtrees, stats and stats.counters()
+    finally:
+        _worker_search.reset()
+
+def split_search_tree(search, min_tasks):
+    """
+    先頭のパターンから順に候補の選択で探索木を分割し、min_tasks 個以上のサブツリー
+    [(選択済みプレフィックス, 0), ...] を返す (パターンが尽きた場合はそれより少ない)。
+    search に symmetry がある場合、対称性で移り合うプレフィックスは1つだけを残す。
+    """
+    order = search.pattern_order()
+    prefixes = [[]]
+    for p in order[:-1]:
+        if len(prefixes) >= min_tasks:
+            break
+        next_prefixes = []
+        seen_selections = set()
+        for prefix in prefixes:
+            if not search.assign_prefix(prefix):
+                continue
+            for index in search.search_candidates(p):
+                search.assign(p, search.candidates[p][index])
+                if search.is_feasible():
+                    selection = search.canonical_selection()
+                    if selection not in seen_selections:
+                        seen_selections.add(selection)
+                        next_prefixes.append(prefix + [(p, index)])
+                search.unassign()
+            search.reset()
+        prefixes = next_prefixes
+    return [(prefix, 0) for prefix in prefixes]
+
+def find_euler_circuit_by_parallel_search(patterns_list, pattern_to_edges_map, all_nodes, start_node_initial, workers,
+                                         symmetry=None, stats=None):
+    """
+    find_euler_circuit_by_search の並列版。
+    先頭のいくつかのパターンの候補で探索木を分割してプロセスプールで探索する。
+    展開ノード数が上限を超えたタスクは未探索部分を分割して返し、空いたワーカーがそれを引き取る。
+    いずれかのワーカーが閉路を見つけたら、共有イベントで他のワーカーの探索を打ち切る。
+    stats (SearchStats) を指定すると、完了したタスクごとにワーカーのカウンタを集約する
+    (探索済みの割合はタスクの重みが分からないため推定しない)。
+    """
+    search = make_pattern_search(patterns_list, pattern_to_edges_map, all_nodes, start_node_initial, symmetry)
+    tasks = split_search_tree(search, workers * PARALLEL_TASKS_PER_WORKER)
+
+    context = multiprocessing.get_context()
+    cancel_event = context.Event()
+    executor = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=context,
+        initializer=_init_search_worker,
+        initargs=(patterns_list, pattern_to_edges_map, all_nodes, start_node_initial, cancel_event, symmetry)
+    )
+    collect_stats = stats is not None
+    if collect_stats:
+        stats.coverage = None
+    try:
+        pending = {executor.submit(_search_subtree, prefix, skip, PARALLEL_SPLIT_NODE_LIMIT, collect_stats)
+                   for prefix, skip in tasks}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                euler_circuit, subtrees, counters = future.result()
+                if collect_stats:
+                    stats.merge(counters)
+                    stats.maybe_report()
+                if euler_circuit is not None:
+                    return euler_circuit
+                for prefix, skip in subtrees:
+                    pending.add(executor.submit(_search_subtree, prefix, skip, PARALLEL_SPLIT_NODE_LIMIT, collect_stats))
+        return None
+    finally:
+        cancel_event.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+# =========================================================================
+# 連結シーケンスのストリーミング出力
+# 状態を1つずつ生成してファイル/ストリームに逐次書き出し、閉路長に比例する文字列を保持しない
+# =========================================================================
+
+# バイナリ形式: ヘッダ (マジック, バージョン, N) の後に、各状態を (N+7)//8 バイトのリトルエンディアンで並べる
+SEQUENCE_FILE_MAGIC = b"EULS"
+SEQUENCE_FILE_VERSION = 1
+_SEQUENCE_HEADER = struct.Struct("<4sBH")
+# まとめて write するバイト数の目安
+_SEQUENCE_WRITE_BUFFER = 64 * 1024
+
+def iter_circuit_states(N, S, euler_circuit):
+    """
+    オイラー閉路を連結したひとつなぎの状態列を、整数状態として1つずつ生成する。
+    最初の遷移のS個の状態 (S-1パス) の後に、各遷移の最後の状態を続ける。
+    euler_circuit はイテラブルでよく、1辺ずつ読むため状態列の長さ分のメモリは使わない。
+    """
+    state_mask = (1 << N) - 1
+    for i, (u, v, transition) in enumerate(euler_circuit):
+        if i == 0:
+            yield from unpack_path_int(N, S, transition >> N)
+        yield transition & state_mask
+
+def write_circuit_states(output, N, states):
+    """
+    状態列をバイナリ形式で書き出し、書き出した状態数を返す。
+    output はファイルパス、またはバイナリストリーム (write を持つオブジェクト)。
+    """
+    if not hasattr(output, "write"):
+        with open(output, "wb") as stream:
+            return write_circuit_states(stream, N, states)
+
+    state_bytes = (N + 7) // 8
+    output.write(_SEQUENCE_HEADER.pack(SEQUENCE_FILE_MAGIC, SEQUENCE_FILE_VERSION, N))
+    buffer = bytearray()
+    count = 0
+    for state in states:
+        buffer += state.to_bytes(state_bytes, "little")
+        count += 1
+        if len(buffer) >= _SEQUENCE_WRITE_BUFFER:
+            output.write(buffer)
+            buffer.clear()
+    output.write(buffer)
+    return count
+
+def read_circuit_states(source):
+    """
+    write_circuit_states で書き出した状態列を読み込み、(N, 状態のイテレータ) を返す。
+    source はファイルパス、またはバイナリストリーム。
+    """
+    stream = source if hasattr(source, "read") else open(source, "rb")
+    magic, version, N = _SEQUENCE_HEADER.unpack(stream.read(_SEQUENCE_HEADER.size))
+    if magic != SEQUENCE_FILE_MAGIC or version != SEQUENCE_FILE_VERSION:
+        if stream is not source:
+            stream.close()
+        raise ValueError(f"シーケンスファイルの形式が不正です: magic={magic!r}, version={version}")
+
+    def generate():
+        state_bytes = (N + 7) // 8
+        chunk_size = state_bytes * (_SEQUENCE_WRITE_BUFFER // state_bytes)
+        try:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                for i in range(0, len(chunk), state_bytes):
+                    yield int.from_bytes(chunk[i:i + state_bytes], "little")
+        finally:
+            if stream is not source:
+                stream.close()
 
-    return None # このパターンのどの辺を選んでも閉路が見つからなかった
+    return N, generate()
+
+def render_circuit_states_text(output, N, states, separator="->"):
+    """
+    状態列を 'A->B->...' 形式のテキストとして逐次書き出し、書き出した状態数を返す。
+    output はファイルパス、またはテキストストリーム。
+    """
+    if not hasattr(output, "write"):
+        with open(output, "w", encoding="utf-8") as stream:
+            return render_circuit_states_text(stream, N, states, separator)
+
+    count = 0
+    for state in states:
+        if count:
+            output.write(separator)
+        output.write(format_state_int(N, state))
+        count += 1
+    output.write("\n")
+    return count
+
+def format_circuit_states_preview(N, states, max_chars, separator="->"):
+    """状態列の先頭 max_chars 文字分だけを文字列にする (超える場合は末尾に '...' を付ける)"""
+    parts = []
+    length = 0
+    for state in states:
+        text = format_state_int(N, state) if not parts else separator + format_state_int(N, state)
+        parts.append(text)
+        length += len(text)
+        if length > max_chars:
+            return "".join(parts)[:max_chars] + "..."
+    return "".join(parts)
+
+# =========================================================================
+# S の掃引 (各段のグラフを直前の段から導き、段ごとに結果を返す)
+# =========================================================================
+
+def sweep_euler_circuits(N, max_S, min_S=1, symmetry=False):
+    """
+    S = min_S, ..., max_S について順にオイラー閉路を探索するジェネレータ。
+    グラフは iter_csr_graph_levels で直前の段から導くため、掃引全体の構築コストは
+    max_S の段を1回構築するのとほぼ同じになる。
+    各段で (S, CSRGraph, オイラー閉路 [(始点, 終点, 遷移), ...] or None) を返す。
+    """
+    for graph in iter_csr_graph_levels(N, max_S, min_S):
+        hypercube_symmetry = HypercubeSymmetry(N, graph.S, int(graph.node_keys[0])) if symmetry else None
+        euler_circuit = find_euler_circuit_by_search(
+            list(range(graph.num_patterns)), graph, None, 0, [], graph.num_patterns, 0, hypercube_symmetry)
+        if euler_circuit:
+            euler_circuit = [graph.to_packed_edge(u, v, e) for u, v, e in euler_circuit]
+        yield graph.S, graph, euler_circuit
 
 # =========================================================================
 # メイン処理関数 (探索ロジックに置き換え)
 # =========================================================================
 
-def find_single_euler_circuit_variable_s(N, S, start_state_str='0' * 4):
+def find_single_euler_circuit_variable_s(N, S, start_state_str='0' * 4, workers=1, output=None, text_output=None,
+                                         cache_dir=None, csr=False, symmetry=False, stats=None):
     """
     バックトラック探索を用いて、オイラー閉路を構成する代表辺を選択し、閉路を出力する。
+    workers > 1 の場合は、探索木を分割してプロセスプールで並列に探索する。
+    output / text_output (パスまたはストリーム) を指定すると、連結シーケンスを
+    バイナリ形式 / テキスト形式で逐次書き出す。
+    メモリ: 連結シーケンス (状態や文字列) は1つずつ生成して書き出すため保持しないが、
+    探索結果の閉路の辺のリスト (ユニークパターン数 = 閉路長の個数のタプル) は保持する。
+    探索自体が全パターンの選択を保持するため、ピークメモリは閉路長に比例する部分が残る。
+    cache_dir を指定すると、グラフとパターンのグループ化をディスクキャッシュから読み込む。
+    csr=True の場合は、グラフを CSRGraph (NumPy 配列) として保持して探索する。
+    symmetry=True の場合は、超立方体の対称性で移り合う候補辺の探索を省略する (結果は同一)。
+    stats (SearchStats) を指定すると、フェーズごとの実行時間と探索の計測値を記録し、最後に表示する。
     """
     if S <= 0:
         raise ValueError("Sは1以上の整数である必要があります。")
+    phase = stats.phase if stats is not None else (lambda name: contextlib.nullcontext())
 
-    # 1. 完全グラフの構築
-    mutable_edges_full, total_count_full, start_node_initial = build_euler_graph_variable_s(N, S)
-
-    if total_count_full == 0:
-        return 0, 0, 0, 0
-    
+    # 1. 完全グラフの構築 (整数ビットマスク表現)
     # 2. ビット変化パターンによる辺のグループ化
-    # Key: ビット変化シーケンス, Value: 全ての候補辺のリスト [(始点, 終点, 遷移文字列), ...]
-    pattern_to_edges_map = defaultdict(list)
-    all_nodes = set()
-    
-    for start_node_str, edges_deque in mutable_edges_full.items():
-        all_nodes.add(start_node_str)
-        for end_node_str, transition_str in edges_deque: 
-            all_nodes.add(end_node_str)
-            
-            transition_states = transition_str.split('->')
-            bit_change_key = get_bit_change_sequence(transition_states)
-            
-            # 候補辺として全ての情報をリストに格納
-            pattern_to_edges_map[bit_change_key].append((start_node_str, end_node_str, transition_str))
+    # Key: ビット変化パターン (整数キー), Value: 全ての候補辺のリスト [(始点, 終点, 遷移), ...]
+    if csr:
+        # CSR 形式: パターン番号とノード番号で探索し、出力時に詰めた int に戻す
+        with phase("build"):
+            csr_graph = CSRGraph.from_graph_arrays(*load_graph_arrays(N, S, cache_dir)) if cache_dir is not None else build_csr_graph(N, S)
+        total_count_full, start_node_initial = csr_graph.num_edges, 0
+        if total_count_full == 0:
+            return 0, 0, 0, 0
+        pattern_to_edges_map, all_nodes = csr_graph, None
+    elif cache_dir is not None:
+        with phase("build"):
+            graph_arrays, graph_meta = load_graph_arrays(N, S, cache_dir)
+        total_count_full, start_node_initial = graph_meta["total"], graph_meta["start_node"]
+        if total_count_full == 0:
+            return 0, 0, 0, 0
+        with phase("grouping"):
+            pattern_to_edges_map, all_nodes = group_edges_from_arrays(graph_arrays)
+    else:
+        with phase("build"):
+            mutable_edges_full, total_count_full, start_node_initial = build_euler_graph_variable_s_bitmask(N, S)
+        if total_count_full == 0:
+            return 0, 0, 0, 0
+        with phase("grouping"):
+            pattern_to_edges_map, all_nodes = group_edges_by_pattern(N, S, mutable_edges_full)
 
-    unique_patterns_count = len(pattern_to_edges_map)
-    patterns_list = list(pattern_to_edges_map.keys())
+    if csr:
+        unique_patterns_count = csr_graph.num_patterns
+        patterns_list = list(range(unique_patterns_count))
+    else:
+        unique_patterns_count = len(pattern_to_edges_map)
+        patterns_list = list(pattern_to_edges_map.keys())
     
     print(f"--- N={N}ビット、S={S}ステップ、オイラー閉路構成による重複排除 ---")
     print(f"全Sステップ遷移の総数: **{total_count_full}**")
@@ -319,83 +1694,83 @@ def find_single_euler_circuit_variable_s(N, S, start_state_str='0' * 4):
     
     # 開始ノードを、採用する辺のいずれかの始点ノードにする
     start_node_final = start_node_initial
+    hypercube_symmetry = None
+    if symmetry:
+        start_node_packed = int(csr_graph.node_keys[start_node_final]) if csr else start_node_final
+        hypercube_symmetry = HypercubeSymmetry(N, S, start_node_packed)
     
-    euler_circuit = find_euler_circuit_by_search(
-        patterns_list,                  # 探索するパターンキーのリスト
-        pattern_to_edges_map,           # パターンごとの全候補辺のマップ
-        all_nodes,                      # 全ノードの集合
-        0,                              # 現在のパターンインデックス
-        [],                             # 現在選択された辺のリスト (最初は空)
-        unique_patterns_count,          # ユニークパターンの総数
-        start_node_final                # 探索開始ノード
-    )
+    with phase("search"):
+        if workers > 1:
+            euler_circuit = find_euler_circuit_by_parallel_search(
+                patterns_list, pattern_to_edges_map, all_nodes, start_node_final, workers, hypercube_symmetry, stats
+            )
+        else:
+            euler_circuit = find_euler_circuit_by_search(
+                patterns_list,                  # 探索するパターンキーのリスト
+                pattern_to_edges_map,           # パターンごとの全候補辺のマップ
+                all_nodes,                      # 全ノードの集合
+                0,                              # 現在のパターンインデックス
+                [],                             # 現在選択された辺のリスト (最初は空)
+                unique_patterns_count,          # ユニークパターンの総数
+                start_node_final,               # 探索開始ノード
+                hypercube_symmetry,             # 対称性による枝刈り (None なら行わない)
+                stats                           # 探索の計測 (None なら行わない)
+            )
     
     total_edges_adopted = unique_patterns_count
+    if csr:
+        if euler_circuit:
+            # 辺のリストを2つ同時に持たないよう、その場で詰めた int に置き換える
+            for i, (u, v, e) in enumerate(euler_circuit):
+                euler_circuit[i] = csr_graph.to_packed_edge(u, v, e)
+        start_node_final = int(csr_graph.node_keys[start_node_final])
     
-    # 4. 結果の整形と出力
-    final_sequences_list = []
-    
+    # 4. 結果の整形と出力 (文字列への変換は表示する分のみ行う)
     if euler_circuit:
         print(f"**✅ オイラー閉路（デ・ブルイジン列）が発見されました。**")
         print(f"閉路の長さ: **{len(euler_circuit)}** (採用されたユニークパターン数と一致)")
-         
-        # 閉路を構成する辺のデータ (遷移文字列) のリストを生成
-        sequence_transitions = [edge_data for u, v, edge_data in euler_circuit]
-        final_sequences_list.extend(sequence_transitions) 
-        total_continuous_count = len(final_sequences_list)
+        total_continuous_count = len(euler_circuit)
          
     else:
         print(f"**❌ オイラー閉路は発見されませんでした。**")
         print("（全ての辺の組み合わせを試しましたが、グラフの接続性を保つ辺の選択肢が存在しませんでした）")
+        euler_circuit = []
         total_continuous_count = 0 
 
-    print(f"\n💡 開始ノード: **{start_node_final}** (S-1パス)")
+    print(f"\n💡 開始ノード: **{format_path_int(N, S, start_node_final)}** (S-1パス)")
     
-    # ... (後続の出力処理は変更なし) ...
     # =========================================================================
-    # 【追加】ひとつなぎのシーケンス文字列の表示
+    # ひとつなぎのシーケンスの表示と書き出し (状態を1つずつ生成して処理する)
     # =========================================================================
-    if final_sequences_list:
-        # 最初のSステップ遷移を取得 (例: '0000->0001->0011')
-        first_transition_states = final_sequences_list[0].split('->')
-        
-        # 連結シーケンスの初期状態として、最初の遷移のS-1状態までを含める
-        if S == 1:
-             # S=1 の場合、一つ目の状態 '0000' のみ
-             connected_sequence = first_transition_states[0]
-        else:
-             # S > 1 の場合、S個の状態 (S-1パス) を取得
-             connected_sequence = "->".join(first_transition_states[:-1])
-
-        # 2番目以降の遷移から、最後の1状態のみを抽出して連結する
-        for transition_str in final_sequences_list:
-            last_state = transition_str.split('->')[-1]
-            connected_sequence += "->" + last_state
-
+    if euler_circuit:
         print("\n## 🔗 連結されたひとつなぎのシーケンス")
-        print(f"（合計 {len(connected_sequence.split('->'))} 状態）")
-         
-        if len(connected_sequence) > 200:
-             print(f"> {connected_sequence[:200]}...")
-        else:
-             print(f"> {connected_sequence}")
+        print(f"（合計 {S + len(euler_circuit)} 状態）")
+        print(f"> {format_circuit_states_preview(N, iter_circuit_states(N, S, euler_circuit), 200)}")
+
+        with phase("output"):
+            if output is not None:
+                written = write_circuit_states(output, N, iter_circuit_states(N, S, euler_circuit))
+                print(f"💾 {written} 状態をバイナリ形式で書き出しました。")
+            if text_output is not None:
+                written = render_circuit_states_text(text_output, N, iter_circuit_states(N, S, euler_circuit))
+                print(f"💾 {written} 状態をテキスト形式で書き出しました。")
     # =========================================================================
 
 
     print(f"\n--- シーケンスの詳細 ({total_continuous_count}ステップ) ---")
 
     output_limit = 50
-    for t_idx, transition_str in enumerate(final_sequences_list):
+    for t_idx, (u, v, transition) in enumerate(euler_circuit):
         if t_idx >= output_limit:
             print(f"\n  ... ({total_continuous_count - output_limit}個のステップを省略)")
             break
              
-        # transition_str は文字列として扱われることを確認
-        transition_states = transition_str.split('->')
-        bit_change_key = get_bit_change_sequence(transition_states)
+        transition_str = format_path_int(N, S + 1, transition)
+        bit_change_key = format_bit_change_key_int(N, S, get_bit_change_key_int(N, S + 1, transition))
          
-        state_a_for_bit_change = transition_states[-2] if S > 1 else transition_states[0]
-        state_b_for_bit_change = transition_states[-1]
+        transition_states = unpack_path_int(N, S + 1, transition)
+        state_a_for_bit_change = format_state_int(N, transition_states[-2])
+        state_b_for_bit_change = format_state_int(N, transition_states[-1])
          
         bit_change_detail = format_transition_bit_change(state_a_for_bit_change, state_b_for_bit_change)
          
@@ -404,6 +1779,12 @@ def find_single_euler_circuit_variable_s(N, S, start_state_str='0' * 4):
     print(f"\n--- 最終結果 ---")
     print(f"採用されたユニークなビット変化パターン総数: **{total_edges_adopted}**")
     print(f"オイラー閉路長: **{len(euler_circuit) if euler_circuit else 0}**")
+
+    if stats is not None:
+        print(f"\n--- 探索の計測 ---")
+        print(stats.summary())
+        if stats.profiler is not None:
+            stats.profile_stats().print_stats(20)
          
     return total_count_full, total_edges_adopted, total_edges_adopted - (len(euler_circuit) if euler_circuit else 0), 1
 
@@ -411,9 +1792,10 @@ def find_single_euler_circuit_variable_s(N, S, start_state_str='0' * 4):
 # --------------------------------------------------------------------------
 # 使用例: N=4ビット, S=2ステップ
 # --------------------------------------------------------------------------
-N_BITS_EXAMPLE_1 = 4
-STEP_S_EXAMPLE_1 = 2 
-START_STATE = '0000' 
-print("==============================================")
-print(f"実行: N={N_BITS_EXAMPLE_1}, S={STEP_S_EXAMPLE_1}, オイラー閉路構成で重複排除 (探索あり)")
-total_1, unique_1, remaining_1, seq_count_1 = find_single_euler_circuit_variable_s(N_BITS_EXAMPLE_1, STEP_S_EXAMPLE_1, START_STATE)
\ No newline at end of file
+if __name__ == "__main__":
+    N_BITS_EXAMPLE_1 = 4
+    STEP_S_EXAMPLE_1 = 2 
+    START_STATE = '0000' 
+    print("==============================================")
+    print(f"実行: N={N_BITS_EXAMPLE_1}, S={STEP_S_EXAMPLE_1}, オイラー閉路構成で重複排除 (探索あり)")
+    total_1, unique_1, remaining_1, seq_count_1 = find_single_euler_circuit_variable_s(N_BITS_EXAMPLE_1, STEP_S_EXAMPLE_1, START_STATE)
\ No newline at end of file
@@ -0,0 +1,199 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import calc
+
+# =========================================================================
+# calc.py のオイラー閉路パイプラインのベンチマーク
+# (N, S) の格子ごとに、グラフ構築 / パターンのグループ化 / バックトラック探索 / 出力 の
+# 各フェーズの実行時間とピークメモリを計測し、JSON に書き出す。
+# =========================================================================
+
+BENCH_FORMAT_VERSION = 1
+DEFAULT_N_VALUES = [4, 5, 6]
+DEFAULT_S_VALUES = [1, 2, 3]
+PHASES = ("build", "grouping", "search", "output")
+# 比較モードで回帰とみなす実行時間の比率
+DEFAULT_REGRESSION_THRESHOLD = 1.10
+# これより短いフェーズは計測誤差が大きいため比較しない (秒)
+MIN_COMPARABLE_SECONDS = 0.005
+
+
+def _run_pipeline(N, S, use_csr, phase_hook):
+    """
+    パイプラインを1回実行する。各フェーズは phase_hook(フェーズ名, 関数) で呼び出す。
+    戻り値: (辺の総数, パターン数, 閉路が見つかったか)
+    """
+    if use_csr:
+        graph = phase_hook("build", lambda: calc.build_csr_graph(N, S))
+        # CSR 形式ではグループ化は構築時に済んでいる
+        phase_hook("grouping", lambda: None)
+        total_edges, num_patterns = graph.num_edges, graph.num_patterns
+        euler_circuit = phase_hook("search", lambda: calc.find_euler_circuit_by_search(
+            list(range(num_patterns)), graph, None, 0, [], num_patterns, 0))
+        if euler_circuit:
+            euler_circuit = [graph.to_packed_edge(u, v, e) for u, v, e in euler_circuit]
+    else:
+        mutable_edges, total_edges, start_node = phase_hook("build", lambda: calc.build_euler_graph_variable_s_bitmask(N, S))
+        pattern_to_edges_map, all_nodes = phase_hook("grouping", lambda: calc.group_edges_by_pattern(N, S, mutable_edges))
+        patterns_list = list(pattern_to_edges_map)
+        num_patterns = len(patterns_list)
+        euler_circuit = phase_hook("search", lambda: calc.find_euler_circuit_by_search(
+            patterns_list, pattern_to_edges_map, all_nodes, 0, [], num_patterns, start_node))
+
+    def write_output():
+        with open(os.devnull, "wb") as sink:
+            return calc.write_circuit_states(sink, N, calc.iter_circuit_states(N, S, euler_circuit or []))
+    phase_hook("output", write_output)
+    return total_edges, num_patterns, bool(euler_circuit)
+
+
+def measure_point(N, S, repeat=3, use_csr=False):
+    """
+    1つの (N, S) について各フェーズを計測する。
+    実行時間は repeat 回の最小値、ピークメモリは tracemalloc を有効にした別の1回で計測する
+    (tracemalloc は実行時間を大きく歪めるため)。
+    """
+    seconds = {phase: float("inf") for phase in PHASES}
+
+    def timed(phase, func):
+        start = time.perf_counter()
+        result = func()
+        seconds[phase] = min(seconds[phase], time.perf_counter() - start)
+        return result
+
+    for _ in range(repeat):
+        total_edges, num_patterns, found = _run_pipeline(N, S, use_csr, timed)
+
+    peak_bytes = {}
+
+    def traced(phase, func):
+        # フェーズごとに tracemalloc を開始し直し、そのフェーズで新たに確保されたメモリのピークを測る
+        tracemalloc.start()
+        try:
+            result = func()
+            peak_bytes[phase] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return result
+
+    _run_pipeline(N, S, use_csr, traced)
+
+    return {
+        "N": N,
+        "S": S,
+        "edges": total_edges,
+        "patterns": num_patterns,
+        "found": found,
+        "phases": {phase: {"seconds": seconds[phase], "peak_bytes": peak_bytes[phase]} for phase in PHASES},
+    }
+
+
+def run_benchmark(n_values, s_values, repeat=3, use_csr=False, log=print):
+    """(N, S) の格子全体を計測し、JSON に書き出せる辞書を返す"""
+    results = []
+    for N in n_values:
+        for S in s_values:
+            point = measure_point(N, S, repeat, use_csr)
+            results.append(point)
+            phases = "  ".join(f"{phase}={point['phases'][phase]['seconds'] * 1000:.1f}ms/"
+                               f"{point['phases'][phase]['peak_bytes'] / 1024:.0f}KiB" for phase in PHASES)
+            log(f"N={N} S={S} edges={point['edges']} patterns={point['patterns']} found={point['found']}  {phases}")
+    return {
+        "version": BENCH_FORMAT_VERSION,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "csr": use_csr,
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def compare_results(current, baseline, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    """
+    baseline と比較し、(N, S, フェーズ) ごとの比較結果のリストを返す。
+    各要素: {"N", "S", "phase", "baseline", "current", "ratio", "status"}
+    status は "regression" / "improvement" / "same" / "skipped" (短すぎて比較しない)
+    グラフの形式 (csr) が異なる結果どうしは比較できないため ValueError を送出する。
+    """
+    if current.get("csr", False) != baseline.get("csr", False):
+        raise ValueError(f"グラフの形式が異なるため比較できません (baseline: csr={baseline.get('csr', False)}, "
+                         f"current: csr={current.get('csr', False)})")
+    baseline_points = {(point["N"], point["S"]): point for point in baseline["results"]}
+    comparisons = []
+    for point in current["results"]:
+        base_point = baseline_points.get((point["N"], point["S"]))
+        if base_point is None:
+            continue
+        for phase in PHASES:
+            base_seconds = base_point["phases"][phase]["seconds"]
+            current_seconds = point["phases"][phase]["seconds"]
+            if max(base_seconds, current_seconds) < MIN_COMPARABLE_SECONDS:
+                ratio, status = None, "skipped"
+            else:
+                ratio = current_seconds / max(base_seconds, 1e-9)
+                if ratio > threshold:
+                    status = "regression"
+                elif ratio < 1 / threshold:
+                    status = "improvement"
+                else:
+                    status = "same"
+            comparisons.append({"N": point["N"], "S": point["S"], "phase": phase,
+                                "baseline": base_seconds, "current": current_seconds,
+                                "ratio": ratio, "status": status})
+    return comparisons
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="calc.py のオイラー閉路パイプラインのベンチマーク")
+    parser.add_argument("--n", type=int, nargs="+", default=DEFAULT_N_VALUES, help="計測する N の値")
+    parser.add_argument("--s", type=int, nargs="+", default=DEFAULT_S_VALUES, help="計測する S の値")
+    parser.add_argument("--repeat", type=int, default=3, help="実行時間の計測回数 (最小値を採用)")
+    parser.add_argument("--csr", action="store_true", help="CSR 形式のグラフで計測する")
+    parser.add_argument("--output", default="calc_bench.json", help="結果を書き出す JSON ファイル")
+    parser.add_argument("--compare", metavar="BASELINE_JSON", help="過去の結果と比較し、回帰があれば終了コード 1 を返す")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD, help="回帰とみなす実行時間の比率")
+    args = parser.parse_args(argv)
+
+    # --output と --compare が同じファイルでも比較できるよう、結果を書き出す前に baseline を読み込む
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    current = run_benchmark(args.n, args.s, args.repeat, args.csr)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(current, f, indent=2)
+    print(f"💾 結果を {args.output} に書き出しました。")
+
+    if baseline is None:
+        return 0
+
+    try:
+        comparisons = compare_results(current, baseline, args.threshold)
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 2
+    print(f"\n--- {args.compare} との比較 (閾値 x{args.threshold}) ---")
+    for c in comparisons:
+        if c["status"] == "skipped":
+            continue
+        mark = {"regression": "❌", "improvement": "✅", "same": "  "}[c["status"]]
+        print(f"{mark} N={c['N']} S={c['S']} {c['phase']:<8} {c['baseline'] * 1000:9.2f}ms -> "
+              f"{c['current'] * 1000:9.2f}ms (x{c['ratio']:.2f})")
+    regressions = sum(1 for c in comparisons if c["status"] == "regression")
+    print(f"回帰: {regressions} 件")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
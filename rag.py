@@ -1,112 +1,242 @@
 import sqlite3
 import sqlite_vec
 import struct
-from typing import List, Tuple
+import itertools
+import functools
+import json
+import hashlib
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 import os
 import numpy as np
 
 # --- 設定 ---
 DB_PATH = "./rag_vec0_only_db.sqlite"
 VECTOR_DIM = 4
-VEC_TABLE = "vec_items" 
+VEC_TABLE = "vec_items" # vec0仮想テーブル (id, パーティションキーのtype, embedding のみ)
+CHUNKS_TABLE = "chunks" # 通常のテーブル (チャンクの構造メタデータと本文)
+CHUNKS_STRUCTURE_INDEX = "chunks_structure_idx" # (filename, chapter, section, item, type) の複合インデックス
+GENERATION_TABLE = "rag_generation" # データの世代番号 (行の挿入・削除ごとに増える。クエリキャッシュの無効化に使用)
+STORAGE_TABLE = "rag_storage" # 埋め込みの格納形式 (create_schema で決め、以降は変更しない)
+FLOAT_VECTORS_TABLE = "chunk_vectors" # 量子化モード時に float32 の埋め込みを保持する通常のテーブル (再ランキング用)
+
+# 埋め込みの格納形式
+# - float32: vec0 に float32 のまま格納し、KNN はそのまま厳密な距離
+# - int8: vec0 に int8 に量子化して格納 (1/4)。粗いKNNの候補を float32 で再ランキングする
+# - bit: vec0 に符号の1ビットに量子化して格納 (1/32、ハミング距離)。同上
+STORAGE_FLOAT32 = "float32"
+STORAGE_INT8 = "int8"
+STORAGE_BIT = "bit"
+STORAGE_MODES = (STORAGE_FLOAT32, STORAGE_INT8, STORAGE_BIT)
+INT8_QUANTIZE_SCALE = 1.0 # int8 量子化で ±127 に対応させる値 (正規化済み埋め込みなら 1.0)
+# 量子化モードで粗いKNNから取る候補数の倍率 (候補数 = k * 倍率。これを float32 で再ランキングして k 件に絞る)
+RERANK_CANDIDATE_FACTORS = {STORAGE_INT8: 4, STORAGE_BIT: 16}
 
 TOP_K = 2 # ベクトル検索で取得するシードチャンク数 (TEXTとIMAGEそれぞれからN件取得)
+# 検索するモダリティ (type) の既定値。各モダリティは vec0 のパーティションになっており、モダリティごとにN件取得する
+DEFAULT_MODALITIES = ("TEXT", "IMAGE")
+EXPANDED_MODALITY = "TEXT" # 特定された構造の全チャンクに拡張するモダリティ (それ以外はシードのみ)
+
+CONTEXT_SEPARATOR = "\n---\n" # コンテキスト内のチャンクの区切り
+ESTIMATED_CHARS_PER_TOKEN = 2 # トークン数の概算に使う1トークンあたりの文字数 (日本語と英語が混在する場合のおおよその目安)
+
+QUERY_CACHE_MAX_ENTRIES = 1024 # クエリ結果キャッシュの最大件数 (超えたら最も古く使われたものから削除)
+QUERY_CACHE_TTL_SECONDS = 300.0 # クエリ結果キャッシュの有効期間 (None で無期限)
+
+# フラット厳密検索エンジン (メモリマップした .npy の全件走査)
+FLAT_BLOCK_ROWS = 65536 # 1回の行列積で走査する埋め込みの行数
+FLAT_QUERY_BATCH = 256 # 1回の行列積でまとめて処理するクエリ数
+FLAT_EXPORT_BATCH = 10000 # インデックス書き出し時に1回のクエリで読む行数
+FLAT_EMBEDDINGS_FILE = "embeddings.npy" # (行数, 次元数) の float32。行は (type, id) 順
+FLAT_IDS_FILE = "ids.npy" # 各行のチャンクID (int64)
+FLAT_NORMS_FILE = "norms.npy" # 各行の埋め込みの二乗ノルム (float32)
+FLAT_MANIFEST_FILE = "manifest.json" # 次元数、世代番号、type ごとの行範囲
+
+BULK_INSERT_BATCH_SIZE = 10000 # 一括投入で1トランザクションにまとめる行数
+# 一括投入中のみ適用するPRAGMA (終了後に元の値へ戻す。journal_mode=WAL はデータベースに残る)
+BULK_INSERT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "OFF",
+    "cache_size": "-262144", # 256MiB (負の値はKiB単位)
+    "temp_store": "MEMORY",
+}
 
 # =============================================================================
 # --- 検索クエリ定義 ---
 # =============================================================================
 
-# @brief RAGルールに基づき、単一SQLクエリでコンテキストを取得する
-#         - ステップ1: TEXTからN件、IMAGEからN件を取得し、距離順で上位N件の構造を特定
-#         - ステップ2: 特定された構造のTEXTは全て、IMAGEはステップ1で取得したN件を最終結果とする
-RETRIEVAL_QUERY = f"""
-WITH SeedText AS (
-    -- ステップ 1a: TEXTからN件を取得
-    SELECT 
-        id, 
-        filename, 
-        chapter, 
-        section, 
-        item, 
-        type,
-        text,
-        distance
+## @brief 指定typeのシードN件 (id, distance) を距離順に取得するSQL (格納形式ごとに異なる)
+def _seed_knn_sql(storage: str, type_expr: str) -> str:
+    """
+    float32 では vec0 のKNNをそのまま使います。
+    量子化モードでは vec0 の粗いKNNで :candidate_k 件の候補を取り、
+    float32 の埋め込み (FLOAT_VECTORS_TABLE) との距離で並べ直して上位N件に絞ります。
+    """
+    if storage == STORAGE_FLOAT32:
+        return f"""SELECT id, distance
     FROM {VEC_TABLE}
-    WHERE embedding MATCH :query_embed AND type = 'TEXT'
-    LIMIT :top_k
-),
-SeedImage AS (
-    -- ステップ 1b: IMAGEからN件を取得
+    WHERE embedding MATCH :query_embed AND type = {type_expr}
+    LIMIT :top_k"""
+    return f"""SELECT Candidate.id, vec_distance_l2(V.embedding, :query_embed) AS distance
+    FROM (
+        SELECT id
+        FROM {VEC_TABLE}
+        WHERE embedding MATCH vec_{storage}(:coarse_embed) AND type = {type_expr}
+        LIMIT :candidate_k
+    ) AS Candidate
+    JOIN {FLOAT_VECTORS_TABLE} AS V ON V.id = Candidate.id
+    ORDER BY distance
+    LIMIT :top_k"""
+
+
+# @brief RAGルールに基づき、単一SQLクエリでコンテキストを取得する
+#         - ステップ1: 各モダリティ (type) からN件ずつ取得し、距離順で上位N件の構造を特定
+#         - ステップ2: 特定された構造のTEXTは全て、その他のモダリティはステップ1で取得したN件を最終結果とする
+#         モダリティごとのKNNは vec0 のパーティション (type) 内だけを検索する。
+#         モダリティの組ごとにSQLが異なるため、生成したSQLはキャッシュする (:modality_0, :modality_1, ... に type を渡す)
+@functools.lru_cache(maxsize=None)
+def build_retrieval_query(storage: str = STORAGE_FLOAT32, modalities: Tuple[str, ...] = DEFAULT_MODALITIES) -> str:
+    seed_knn_ctes = "".join(f"""
+SeedKnn{index} AS (
+    -- ステップ 1a: {modality} のパーティションからN件をベクトル検索 (vec0にはidとtypeのみ)
+    {_seed_knn_sql(storage, f":modality_{index}")}
+),""" for index, modality in enumerate(modalities))
+    seed_knn_union = "\n    UNION ALL\n    ".join(f"SELECT id, distance FROM SeedKnn{index}" for index in range(len(modalities)))
+    final_text_chunks = ""
+    if EXPANDED_MODALITY in modalities:
+        final_text_chunks = f"""
+-- ステップ 2a: 特定された構造キーを持つ全てのTEXTチャンクをチャンクテーブルから取得
+-- (構造キーの複合インデックスによる検索となり、コーパス全体は走査しない)
+SELECT
+    T1.id,
+    T1.filename,
+    T1.chapter,
+    T1.section,
+    T1.item,
+    T1.type,
+    T1.text
+FROM TopNStructureKeys AS K
+JOIN {CHUNKS_TABLE} AS T1 ON 
+    T1.filename = K.filename AND
+    T1.chapter = K.chapter AND
+    T1.section = K.section AND
+    T1.item = K.item
+WHERE T1.type = '{EXPANDED_MODALITY}'
+
+UNION ALL
+"""
+    return f"""
+WITH{seed_knn_ctes}
+Seed AS (
+    -- ステップ 1b: 全モダリティのシードにチャンクテーブルのメタデータを主キーで結合
     SELECT 
-        id, 
-        filename, 
-        chapter, 
-        section, 
-        item, 
-        type,
-        text,
-        distance
-    FROM {VEC_TABLE}
-    WHERE embedding MATCH :query_embed AND type = 'IMAGE'
-    LIMIT :top_k
+        C.id, 
+        C.filename, 
+        C.chapter, 
+        C.section, 
+        C.item, 
+        C.type,
+        C.text,
+        S.distance
+    FROM (
+    {seed_knn_union}
+    ) AS S
+    JOIN {CHUNKS_TABLE} AS C ON C.id = S.id
 ),
 TopNStructureKeys AS (
-    -- ステップ 1c: TEXTとIMAGEのシードを結合し、distance順に並び替えて上位N件の構造キーを特定
-    SELECT DISTINCT
+    -- ステップ 1c: 構造キーごとにシードの最小distanceで並び替えて上位N件の構造キーを特定
+    SELECT
         filename,
         chapter,
         section,
         item
-    FROM (
-        SELECT filename, chapter, section, item, distance FROM SeedText
-        UNION ALL
-        SELECT filename, chapter, section, item, distance FROM SeedImage
-    )
-    ORDER BY distance
+    FROM Seed
+    GROUP BY filename, chapter, section, item
+    ORDER BY MIN(distance)
     LIMIT :top_k
-),
-FinalTextChunks AS (
-    -- ステップ 2a: 特定された構造キーを持つ全てのTEXTチャンクをオリジナルテーブルから取得
-    SELECT
-        T1.id,
-        T1.filename,
-        T1.chapter,
-        T1.section,
-        T1.item,
-        T1.type,
-        T1.text
-    FROM {VEC_TABLE} AS T1
-    JOIN TopNStructureKeys AS K ON 
-        T1.filename = K.filename AND
-        T1.chapter = K.chapter AND
-        T1.section = K.section AND
-        T1.item = K.item
-    WHERE T1.type = 'TEXT'
-),
-FinalImageChunks AS (
-    -- ステップ 2b: 特定された構造キーを持つ、かつステップ1で取得されたIMAGEチャンクを再取得
-    -- (IMAGEチャンクはSeedImageに限定される)
+)
+-- 最終 SELECT: TEXTチャンクと、その他のモダリティのチャンクを結合
+{final_text_chunks}
+-- ステップ 2b: 特定された構造キーを持つ、かつステップ1で取得されたTEXT以外のチャンク
+SELECT S.id, S.filename, S.chapter, S.section, S.item, S.type, S.text
+FROM Seed AS S
+JOIN TopNStructureKeys AS K ON 
+    S.filename = K.filename AND
+    S.chapter = K.chapter AND
+    S.section = K.section AND
+    S.item = K.item
+WHERE S.type != '{EXPANDED_MODALITY}';
+"""
+
+
+# @brief バッチ検索用: RETRIEVAL_QUERY のステップ1a/1b (指定typeのシードをN件取得) のみを行うクエリ
+def build_seed_query(storage: str = STORAGE_FLOAT32) -> str:
+    return f"""
+WITH Knn AS (
+    {_seed_knn_sql(storage, ":type")}
+)
+SELECT C.id, C.filename, C.chapter, C.section, C.item, C.type, C.text, S.distance
+FROM Knn AS S
+JOIN {CHUNKS_TABLE} AS C ON C.id = S.id
+ORDER BY S.distance
+"""
+
+
+SEED_QUERIES = {storage: build_seed_query(storage) for storage in STORAGE_MODES}
+RETRIEVAL_QUERY = build_retrieval_query()
+SEED_QUERY = SEED_QUERIES[STORAGE_FLOAT32]
+
+# @brief 再現率の計測用: 指定typeのシードN件を float32 の全件走査 (厳密な距離) で取得するクエリ
+#         (量子化モードでは FLOAT_VECTORS_TABLE、float32 では vec0 の埋め込みを直接走査する)
+def build_exact_seed_query(storage: str = STORAGE_FLOAT32) -> str:
+    vectors_table = VEC_TABLE if storage == STORAGE_FLOAT32 else FLOAT_VECTORS_TABLE
+    return f"""
+SELECT V.id
+FROM {vectors_table} AS V
+JOIN {CHUNKS_TABLE} AS C ON C.id = V.id
+WHERE C.type = :type
+ORDER BY vec_distance_l2(V.embedding, :query_embed), V.id
+LIMIT :top_k
+"""
+
+
+# @brief バッチ検索用: RETRIEVAL_QUERY のステップ2a (構造キーを持つ全TEXTチャンクの取得) を
+#         バッチ内の全クエリの構造キーの和集合に対して1回だけ行うクエリ
+#         (:structure_keys は [[filename, chapter, section, item], ...] のJSON)
+EXPANSION_QUERY = f"""
+WITH StructureKeys AS (
     SELECT
-        S.id,
-        S.filename,
-        S.chapter,
-        S.section,
-        S.item,
-        S.type,
-        S.text
-    FROM SeedImage AS S -- SeedImage (ステップ1で取得したN件のIMAGE) の結果を元にする
-    JOIN TopNStructureKeys AS K ON 
-        S.filename = K.filename AND
-        S.chapter = K.chapter AND
-        S.section = K.section AND
-        S.item = K.item
+        json_extract(value, '$[0]') AS filename,
+        json_extract(value, '$[1]') AS chapter,
+        json_extract(value, '$[2]') AS section,
+        json_extract(value, '$[3]') AS item
+    FROM json_each(:structure_keys)
 )
--- 最終 SELECT: TEXTチャンクとIMAGEチャンクを結合し、ID順にソート
-SELECT id, filename, chapter, section, item, type, text FROM FinalTextChunks
+SELECT
+    T1.id,
+    T1.filename,
+    T1.chapter,
+    T1.section,
+    T1.item,
+    T1.type,
+    T1.text
+FROM StructureKeys AS K
+JOIN {CHUNKS_TABLE} AS T1 ON
+    T1.filename = K.filename AND
+    T1.chapter = K.chapter AND
+    T1.section = K.section AND
+    T1.item = K.item
+WHERE T1.type = '{EXPANDED_MODALITY}'
+"""
 
-UNION ALL
 
-SELECT id, filename, chapter, section, item, type, text FROM FinalImageChunks;
+# @brief フラット検索用: JSON配列で渡したIDのチャンクを取得するクエリ (:chunk_ids は [id, ...] のJSON)
+CHUNKS_BY_ID_QUERY = f"""
+SELECT C.id, C.filename, C.chapter, C.section, C.item, C.type, C.text
+FROM json_each(:chunk_ids) AS J
+JOIN {CHUNKS_TABLE} AS C ON C.id = J.value
 """
 
 
@@ -128,13 +258,226 @@ def serialize_vector(vector: List[float]) -> bytes:
     return struct.pack(format_string, *vector)
 
 
+## @brief 埋め込み行列の各行を、コピーせずにBLOB (memoryview) として取り出す
+def serialize_matrix_rows(embeddings: np.ndarray) -> List[memoryview]:
+    """
+    (行数, 次元数) の行列を行ごとのBLOBに分割します。
+    リトルエンディアンのfloat32でC連続な配列 (np.memmapを含む) はコピーせず、元のバッファを参照します。
+    """
+    matrix = np.ascontiguousarray(embeddings, dtype="<f4")
+    if matrix.ndim != 2:
+        raise ValueError(f"埋め込み行列は2次元である必要があります: shape={matrix.shape}")
+    if matrix.shape[0] == 0:
+        return []
+    row_bytes = matrix.shape[1] * matrix.itemsize
+    buffer = memoryview(matrix).cast("B")
+    return [buffer[offset:offset + row_bytes] for offset in range(0, len(buffer), row_bytes)]
+
+
+## @brief 埋め込み (行列、行列のブロック、ベクトルのいずれかの列) から行ごとのBLOBを順に返す
+def _iter_embedding_blobs(embeddings: Union[np.ndarray, Iterable]) -> Iterator[Union[bytes, memoryview]]:
+    if isinstance(embeddings, np.ndarray):
+        embeddings = (embeddings,)
+    for block in embeddings:
+        if isinstance(block, np.ndarray) and block.ndim == 2:
+            yield from serialize_matrix_rows(block)
+        else:
+            yield serialize_vector(block)
+
+
+## @brief float32 の埋め込み行列を、格納形式 (int8 / bit) のvec0用BLOBに量子化する
+def quantize_matrix_rows(embeddings: np.ndarray, storage: str, int8_scale: float = INT8_QUANTIZE_SCALE) -> List[bytes]:
+    """
+    int8: x * 127 / int8_scale を丸めて [-127, 127] に収めます (全行共通のスケール)。
+    bit: x > 0 を1ビットとし、sqlite-vec の vec_quantize_binary と同じくリトルエンディアンのビット順で詰めます。
+    """
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    if storage == STORAGE_INT8:
+        quantized = np.clip(np.rint(matrix * (127.0 / int8_scale)), -127, 127).astype(np.int8)
+    elif storage == STORAGE_BIT:
+        quantized = np.packbits(matrix > 0, axis=1, bitorder="little")
+    else:
+        raise ValueError(f"量子化できない格納形式です: {storage}")
+    return [row.tobytes() for row in quantized]
+
+
+## @brief 格納形式ごとの、vec0に格納される埋め込み1件あたりのバイト数
+def embedding_bytes(vec_dim: int, storage: str) -> int:
+    return {STORAGE_FLOAT32: vec_dim * 4, STORAGE_INT8: vec_dim, STORAGE_BIT: vec_dim // 8}[storage]
+
+
+# =============================================================================
+# --- 一括投入 ---
+# =============================================================================
+
+## @brief 一括投入用のPRAGMAを適用し、元の値を返す
+def _apply_pragmas(db: sqlite3.Connection, pragmas: Dict[str, str]) -> Dict[str, str]:
+    previous = {}
+    for name, value in pragmas.items():
+        # journal_mode はトランザクション中に変更できない
+        if name == "journal_mode" and db.in_transaction:
+            continue
+        previous[name] = db.execute(f"PRAGMA {name}").fetchone()[0]
+        db.execute(f"PRAGMA {name} = {value}")
+    return previous
+
+
+## @brief チャンクテーブル (構造キーの複合インデックス付き) とvec0仮想テーブルを作成する
+def create_schema(
+    db: sqlite3.Connection,
+    vec_dim: int,
+    storage: str = STORAGE_FLOAT32,
+    int8_scale: float = INT8_QUANTIZE_SCALE
+):
+    """
+    メタデータと本文は通常のテーブル、埋め込みはvec0仮想テーブルに分けて格納します。
+    vec0にはtypeのみをパーティションキーとして残し、シード検索は該当typeのパーティションだけを走査します。
+    storage に int8 / bit を指定すると、vec0には量子化した埋め込みを格納し、
+    float32 の埋め込みは再ランキング用に FLOAT_VECTORS_TABLE に格納します。
+    """
+    if storage not in STORAGE_MODES:
+        raise ValueError(f"格納形式は {STORAGE_MODES} のいずれかである必要があります: {storage}")
+    if storage == STORAGE_BIT and vec_dim % 8 != 0:
+        raise ValueError(f"bit 形式では次元数が8の倍数である必要があります: {vec_dim}")
+    with db:
+        db.execute(f"""
+            CREATE TABLE {CHUNKS_TABLE} (
+                id INTEGER PRIMARY KEY,
+                filename TEXT,
+                chapter TEXT,
+                section TEXT,
+                item TEXT,
+                type TEXT,
+                text TEXT
+            );
+        """)
+        db.execute(f"""
+            CREATE INDEX {CHUNKS_STRUCTURE_INDEX}
+            ON {CHUNKS_TABLE}(filename, chapter, section, item, type);
+        """)
+        db.execute(f"""
+            CREATE VIRTUAL TABLE {VEC_TABLE} USING vec0(
+                id INTEGER PRIMARY KEY,
+                type TEXT PARTITION KEY,
+                embedding {storage}[{vec_dim}]
+            );
+        """)
+        if storage != STORAGE_FLOAT32:
+            db.execute(f"CREATE TABLE {FLOAT_VECTORS_TABLE} (id INTEGER PRIMARY KEY, embedding BLOB NOT NULL);")
+        db.execute(f"CREATE TABLE {GENERATION_TABLE} (generation INTEGER NOT NULL);")
+        db.execute(f"INSERT INTO {GENERATION_TABLE}(generation) VALUES (0);")
+        db.execute(f"CREATE TABLE {STORAGE_TABLE} (storage TEXT NOT NULL, int8_scale REAL NOT NULL);")
+        db.execute(f"INSERT INTO {STORAGE_TABLE}(storage, int8_scale) VALUES (?, ?);", (storage, int8_scale))
+
+
+## @brief 埋め込みの格納形式と int8 量子化のスケールを返す
+def get_storage(db: sqlite3.Connection) -> Tuple[str, float]:
+    return db.execute(f"SELECT storage, int8_scale FROM {STORAGE_TABLE};").fetchone()
+
+
+## @brief データの世代番号を進める (行を挿入・削除するトランザクション内で呼ぶ)
+def bump_generation(db: sqlite3.Connection):
+    db.execute(f"UPDATE {GENERATION_TABLE} SET generation = generation + 1;")
+
+
+## @brief 現在のデータの世代番号を返す
+def get_generation(db: sqlite3.Connection) -> int:
+    return db.execute(f"SELECT generation FROM {GENERATION_TABLE};").fetchone()[0]
+
+
+## @brief 格納されている埋め込みの次元数を返す (行がなければ None)
+def get_vec_dim(db: sqlite3.Connection) -> Optional[int]:
+    row = db.execute(f"SELECT vec_length(embedding) FROM {VEC_TABLE} LIMIT 1;").fetchone()
+    return None if row is None else row[0]
+
+
+## @brief メタデータの行と埋め込みを、executemanyでバッチごとにチャンクテーブルとvec0仮想テーブルへ挿入する
+def bulk_insert_chunks(
+    db: sqlite3.Connection,
+    metadata_rows: Iterable[Tuple],
+    embeddings: Union[np.ndarray, Iterable],
+    vec_dim: int,
+    batch_size: int = BULK_INSERT_BATCH_SIZE,
+    pragmas: Dict[str, str] = BULK_INSERT_PRAGMAS
+) -> int:
+    """
+    metadata_rows: (id, filename, chapter, section, item, type, text) の行のイテラブル (ジェネレータ可)
+    embeddings: (行数, vec_dim) のfloat32行列 (np.memmap可)、その行列ブロックのイテラブル、
+                またはベクトルのイテラブル。metadata_rows と同じ順序・行数であること。
+    batch_size 行ごとに1トランザクションでコミットするため、入力全体をメモリに載せずに投入できます。
+    量子化モードのデータベースでは、バッチごとに量子化してvec0に、float32 のまま FLOAT_VECTORS_TABLE に挿入します。
+    挿入した行数を返します。
+    """
+    storage, int8_scale = get_storage(db)
+    insert_chunk_sql = f"""
+        INSERT INTO {CHUNKS_TABLE}(id, filename, chapter, section, item, type, text)
+        VALUES (?, ?, ?, ?, ?, ?, ?);
+    """
+    insert_vector_sql = f"""
+        INSERT INTO {VEC_TABLE}(id, type, embedding)
+        VALUES (?, ?, {"?" if storage == STORAGE_FLOAT32 else f"vec_{storage}(?)"});
+    """
+    insert_float_vector_sql = f"""
+        INSERT INTO {FLOAT_VECTORS_TABLE}(id, embedding)
+        VALUES (?, ?);
+    """
+    row_bytes = vec_dim * 4
+    rows = iter(metadata_rows)
+    blobs = _iter_embedding_blobs(embeddings)
+    missing = object()
+    inserted = 0
+    previous_pragmas = _apply_pragmas(db, pragmas)
+    try:
+        while True:
+            batch = []
+            for row, blob in itertools.zip_longest(itertools.islice(rows, batch_size),
+                                                   itertools.islice(blobs, batch_size), fillvalue=missing):
+                if row is missing or blob is missing:
+                    raise ValueError(f"メタデータと埋め込みの行数が一致しません ({inserted + len(batch)} 行目まで対応)。")
+                if len(blob) != row_bytes:
+                    raise ValueError(f"ID {row[0]} の埋め込みの次元数が {vec_dim} ではありません。")
+                batch.append((tuple(row), blob))
+            if not batch:
+                break
+            with db:
+                db.executemany(insert_chunk_sql, (row for row, _ in batch))
+                if storage == STORAGE_FLOAT32:
+                    db.executemany(insert_vector_sql, ((row[0], row[5], blob) for row, blob in batch))
+                else:
+                    matrix = np.frombuffer(b"".join(blob for _, blob in batch), dtype="<f4").reshape(len(batch), vec_dim)
+                    coarse_blobs = quantize_matrix_rows(matrix, storage, int8_scale)
+                    db.executemany(insert_vector_sql, ((row[0], row[5], coarse) for (row, _), coarse in zip(batch, coarse_blobs)))
+                    db.executemany(insert_float_vector_sql, ((row[0], blob) for row, blob in batch))
+                bump_generation(db)
+            inserted += len(batch)
+            if len(batch) < batch_size:
+                break
+    finally:
+        _apply_pragmas(db, {name: value for name, value in previous_pragmas.items() if name != "journal_mode"})
+    return inserted
+
+
+## @brief 指定したIDのチャンクを、チャンクテーブルとvec0仮想テーブルの両方から削除する
+def delete_chunks(db: sqlite3.Connection, chunk_ids: Iterable[int]) -> int:
+    """
+    削除した行数を返します。
+    """
+    id_params = [(chunk_id,) for chunk_id in chunk_ids]
+    with db:
+        deleted = db.executemany(f"DELETE FROM {CHUNKS_TABLE} WHERE id = ?;", id_params).rowcount
+        db.executemany(f"DELETE FROM {VEC_TABLE} WHERE id = ?;", id_params)
+        if get_storage(db)[0] != STORAGE_FLOAT32:
+            db.executemany(f"DELETE FROM {FLOAT_VECTORS_TABLE} WHERE id = ?;", id_params)
+        bump_generation(db)
+    return deleted
+
+
 # =============================================================================
 ## @brief データベースの初期化、vec0仮想テーブルの作成、データの挿入を行う
-def setup_database(db: sqlite3.Connection, dummy_data: List[Tuple], vec_dim: int):
+def setup_database(db: sqlite3.Connection, dummy_data: List[Tuple], vec_dim: int, storage: str = STORAGE_FLOAT32):
     """
-    RAGに必要な全てのデータを格納するvec0仮想テーブルを作成し、データを挿入します。
+    チャンクテーブルとvec0仮想テーブルを作成し、データを挿入します。
     """
-    cursor = db.cursor()
     db.enable_load_extension(True)
     sqlite_vec.load(db) 
     db.enable_load_extension(False)
@@ -142,95 +485,592 @@ def setup_database(db: sqlite3.Connection, dummy_data: List[Tuple], vec_dim: int
     print(f"sqlite-vec Version: {db.execute('SELECT vec_version()').fetchone()[0]}")
     print("-" * 30)
 
-    # 1. vec0仮想テーブルの作成 (全てのRAGメタデータを含む)
-    print(f"1. VIRTUAL TABLE {VEC_TABLE} (vec0) を作成 (全RAGデータを含む)...")
+    # 1. テーブルの作成 (メタデータは通常のテーブル、埋め込みはvec0仮想テーブル)
+    print(f"1. TABLE {CHUNKS_TABLE} (構造キーのインデックス付き) と VIRTUAL TABLE {VEC_TABLE} (vec0) を作成...")
     try:
-        db.execute(f"""
-            CREATE VIRTUAL TABLE {VEC_TABLE} USING vec0(
-                id INTEGER,
-                filename TEXT,
-                chapter TEXT,
-                section TEXT,
-                item TEXT,
-                type TEXT, 
-                text TEXT,
-                embedding float[{vec_dim}]
-            );
-        """)
-        print("✅ vec0仮想テーブル作成完了。")
+        create_schema(db, vec_dim, storage)
+        print("✅ テーブル作成完了。")
     except sqlite3.OperationalError as e:
         print(f"⚠ テーブル作成エラー (既に存在している可能性): {e}")
 
-    # 2. データの挿入
+    # 2. データの挿入 (一括投入の経路を使用)
     print("\n🚀 データの挿入...")
-    with db:
-        for data in dummy_data:
-            vector = data[-1]
-            serialized_vector = serialize_vector(vector)
-            insert_data = data[:-1] + (serialized_vector,)
-             
-            cursor.execute(f"""
-                INSERT INTO {VEC_TABLE}(id, filename, chapter, section, item, type, text, embedding)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?);
-            """, insert_data)
-             
-        print(f"✅ {len(dummy_data)} 個のアイテムが挿入されました。")
+    inserted = bulk_insert_chunks(
+        db,
+        (data[:-1] for data in dummy_data),
+        (data[-1] for data in dummy_data),
+        vec_dim
+    )
+    print(f"✅ {inserted} 個のアイテムが挿入されました。")
+
+
+# =============================================================================
+# --- クエリ結果キャッシュ ---
+# =============================================================================
+
+## @brief クエリベクトルとkをキーとする、検索結果 (整形済みコンテキスト) のLRUキャッシュ
+class QueryCache:
+    """
+    キーはシリアライズしたクエリベクトル、k、検索するモダリティ (と文字数・トークン数の上限) のハッシュです。
+    件数の上限 (LRU) と有効期間 (TTL) で削除し、データの世代番号 (rag_generation) が
+    変わったら全件を無効化します。スレッドセーフです。
+    """
+    def __init__(self, max_entries: int = QUERY_CACHE_MAX_ENTRIES, ttl_seconds: Optional[float] = QUERY_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict() # キー -> (格納時刻, 値)
+        self._generation = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(
+        serialized_query: bytes,
+        k: int,
+        modalities: Tuple[str, ...] = DEFAULT_MODALITIES,
+        budget: Tuple = ()
+    ) -> bytes:
+        digest = hashlib.sha256(bytes(serialized_query) + k.to_bytes(8, "little", signed=True))
+        digest.update("\0".join(modalities).encode("utf-8"))
+        # 上限が全て None (上限なし) の budget は () と同じキーにする (入口によらず同じクエリは同じエントリを使う)
+        if any(limit is not None for limit in budget):
+            digest.update(repr(tuple(budget)).encode("utf-8"))
+        return digest.digest()
+
+    def _sync_generation(self, generation: int):
+        if generation != self._generation:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._generation = generation
+
+    def get(self, key: bytes, generation: int):
+        """キャッシュされた値を返す (無ければ None)"""
+        with self._lock:
+            self._sync_generation(generation)
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl_seconds is not None and time.monotonic() - entry[0] > self.ttl_seconds:
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: bytes, generation: int, value):
+        with self._lock:
+            self._sync_generation(generation)
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        """ヒット/ミスなどの統計"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
 
 
 # =============================================================================
 # --- RAG検索関数 ---
 # =============================================================================
 
+## @brief チャンクの行1つを、コンテキスト内の1チャンク分のテキストに整形する
+def format_chunk(row: Tuple) -> str:
+    """
+    row: (id, filename, chapter, section, item, type, text)
+    """
+    chunk_id, filename, chapter, section, item, chunk_type, text = row[:7]
+     
+    # type='IMAGE' の場合は画像タグを追加
+    if chunk_type == 'IMAGE':
+         text = f"[Image: {filename}/{chapter}/{section}/{item} - {text}]" 
+
+    header = f"  [ID:{chunk_id} | {filename} / Ch:{chapter} Sec:{section} Item:{item} | Type:{chunk_type}]"
+    return f"{header}\n{text}\n"
+
+
+## @brief トークン数を文字数から概算する (正確に数える場合は LLM のトークナイザの関数を渡す)
+def estimate_tokens(text: str) -> int:
+    return -(-len(text) // ESTIMATED_CHARS_PER_TOKEN)
+
+
+## @brief チャンクの行を順に整形し、コンテキストの断片として1つずつ返す (上限に達したら打ち切る)
+def iter_context_pieces(
+    rows: Iterable[Tuple],
+    max_chars: Optional[int] = None,
+    max_tokens: Optional[int] = None,
+    token_counter: Callable[[str], int] = estimate_tokens,
+    summary: Optional[Dict[str, object]] = None
+) -> Iterator[str]:
+    """
+    2つ目以降の断片は先頭に区切り (CONTEXT_SEPARATOR) を含むため、"".join() すると format_context と同じテキストになります。
+    rows はカーソルのまま渡せます。行は必要になった時点で1行ずつ読み、
+    次のチャンクを加えると max_chars / max_tokens を超える時点で読むのをやめます (チャンクの途中では切りません)。
+    summary を渡すと、終了時に chunks (返したチャンク数)、chars、tokens、truncated (打ち切ったか) を書き込みます。
+    """
+    chunks = chars = tokens = 0
+    truncated = False
+    try:
+        for row in rows:
+            piece = format_chunk(row) if chunks == 0 else CONTEXT_SEPARATOR + format_chunk(row)
+            piece_tokens = token_counter(piece) if max_tokens is not None else 0
+            if ((max_chars is not None and chars + len(piece) > max_chars) or
+                    (max_tokens is not None and tokens + piece_tokens > max_tokens)):
+                truncated = True
+                break
+            chunks += 1
+            chars += len(piece)
+            tokens += piece_tokens
+            yield piece
+    finally:
+        if summary is not None:
+            summary.update(chunks=chunks, chars=chars, tokens=tokens if max_tokens is not None else None, truncated=truncated)
+
+
+## @brief 取得したチャンクの行を、LLMに渡すコンテキストのテキストに整形する
+def format_context(context_data: List[Tuple]) -> str:
+    """
+    row: (id, filename, chapter, section, item, type, text) のリストを整形します。
+    """
+    return "".join(iter_context_pieces(context_data))
+
+
+## @brief ベクトル検索と文脈拡張を行い、コンテキストを1チャンクずつ遅延して返す
+def stream_chunks_for_rag(
+    db: sqlite3.Connection,
+    query_vector: List[float],
+    k: int,
+    modalities: Iterable[str] = DEFAULT_MODALITIES,
+    max_chars: Optional[int] = None,
+    max_tokens: Optional[int] = None,
+    token_counter: Callable[[str], int] = estimate_tokens,
+    summary: Optional[Dict[str, object]] = None
+) -> Iterator[str]:
+    """
+    retrieve_chunks_for_rag と同じ単一SQLクエリを実行し、fetchall() せずにカーソルから1行ずつ整形して返します。
+    上限 (max_chars / max_tokens) に達するとカーソルを閉じ、残りの行は SQLite から読み出しません。
+    そのため構造グループがどれだけ大きくても、遅延とメモリは上限の大きさで抑えられます。
+    表示は行いません (summary で件数・文字数・打ち切りの有無を受け取れます)。
+    """
+    modalities = normalize_modalities(modalities)
+    storage, int8_scale = get_storage(db)
+    params = _seed_params(storage, int8_scale, serialize_vector(query_vector), k)
+    params.update((f"modality_{index}", modality) for index, modality in enumerate(modalities))
+
+    # 単一SQLクエリを実行 (量子化モードでは粗いKNNの候補を float32 で再ランキングする)
+    cursor = db.execute(build_retrieval_query(storage, modalities), params)
+    try:
+        yield from iter_context_pieces(cursor, max_chars, max_tokens, token_counter, summary)
+    finally:
+        cursor.close()
+
+
 ## @brief ベクトル検索と文脈拡張を行い、RAG用のコンテキストを取得する
 def retrieve_chunks_for_rag(
     db: sqlite3.Connection, 
     query_vector: List[float], 
-    k: int
+    k: int,
+    cache: Optional[QueryCache] = None,
+    modalities: Iterable[str] = DEFAULT_MODALITIES,
+    max_chars: Optional[int] = None,
+    max_tokens: Optional[int] = None,
+    verbose: bool = True
 ) -> str:
     """
     RAGルールに基づき、コンテキストを取得し、整形されたテキストを返します。
+    modalities に検索するtypeを指定します (typeごとにN件のシードを取得)。
+    cache を指定すると、同じクエリベクトルとkの結果を (データが更新されるまで) 再利用します。
+    max_chars / max_tokens を指定すると、上限に収まるチャンクまでで打ち切ります (stream_chunks_for_rag を参照)。
+    verbose=False では何も表示しません。表示は検索と整形が終わった後にまとめて行います。
     """
-    cursor = db.cursor()
+    modalities = normalize_modalities(modalities)
     serialized_query = serialize_vector(query_vector)
      
-    print(f"\n🔍 RAG統合検索 (K={k}, 新しい構造拡張ロジック)...")
-     
-    params = {
-        'query_embed': serialized_query,
-        'top_k': k
-    }
-
-    # 単一SQLクエリを実行
-    cursor.execute(RETRIEVAL_QUERY, params)
-    context_data = cursor.fetchall()
+    if verbose:
+        print(f"\n🔍 RAG統合検索 (K={k}, 新しい構造拡張ロジック)...")
 
-    if not context_data:
-        print("関連性の高いチャンクは見つかりませんでした。")
-        return ""
-
-    # --- データの整形と表示 ---
-    combined_context = []
+    if cache is not None:
+        cache_key = QueryCache.make_key(serialized_query, k, modalities, (max_chars, max_tokens))
+        generation = get_generation(db)
+        cached_context = cache.get(cache_key, generation)
+        if cached_context is not None:
+            if verbose:
+                print("   ✅ キャッシュから取得しました。")
+            return cached_context
      
-    for row in context_data:
-        # row: (id, filename, chapter, section, item, type, text)
-        chunk_id, filename, chapter, section, item, chunk_type, text = row
-         
-        # type='IMAGE' の場合は画像タグを追加
-        if chunk_type == 'IMAGE':
-             text = f"[Image: {filename}/{chapter}/{section}/{item} - {text}]" 
+    summary = {}
+    final_context_text = "".join(stream_chunks_for_rag(
+        db, query_vector, k, modalities, max_chars, max_tokens, summary=summary))
+    if cache is not None:
+        cache.put(cache_key, generation, final_context_text)
 
-        header = f"  [ID:{chunk_id} | {filename} / Ch:{chapter} Sec:{section} Item:{item} | Type:{chunk_type}]"
-        combined_context.append(f"{header}\n{text}\n")
+    if not verbose:
+        return final_context_text
 
-    final_context_text = "\n---\n".join(combined_context)
+    # --- 表示 ---
+    if summary["chunks"] == 0 and not summary["truncated"]:
+        print("関連性の高いチャンクは見つかりませんでした。")
+        return final_context_text
 
-    print(f"   ✅ 取得した合計チャンク数: {len(context_data)}")
+    print(f"   ✅ 取得した合計チャンク数: {summary['chunks']}")
+    if summary["truncated"]:
+        print(f"   ✂ 上限 (文字数={max_chars}, トークン数={max_tokens}) に達したため、残りのチャンクを打ち切りました。")
     print("\n--- LLMに渡す最終コンテキスト ---")
     print(final_context_text)
      
     return final_context_text
 
 
+## @brief 検索するモダリティを、重複を除いたタプルにする
+def normalize_modalities(modalities: Iterable[str]) -> Tuple[str, ...]:
+    if isinstance(modalities, str):
+        modalities = (modalities,)
+    modalities = tuple(dict.fromkeys(modalities))
+    if not modalities:
+        raise ValueError("検索するモダリティを1つ以上指定する必要があります。")
+    return modalities
+
+
+## @brief シード検索のパラメータ (格納形式に応じて量子化したクエリと候補数を含む) を作る
+def _seed_params(storage: str, int8_scale: float, query_blob: Union[bytes, memoryview], k: int) -> Dict[str, object]:
+    params = {'query_embed': query_blob, 'top_k': k}
+    if storage != STORAGE_FLOAT32:
+        query_matrix = np.frombuffer(query_blob, dtype="<f4")[np.newaxis, :]
+        params['coarse_embed'] = quantize_matrix_rows(query_matrix, storage, int8_scale)[0]
+        params['candidate_k'] = k * RERANK_CANDIDATE_FACTORS[storage]
+    return params
+
+
+## @brief シードチャンクから、distanceの小さい順に重複のない構造キーを上位N件選ぶ (RETRIEVAL_QUERY のステップ1c)
+def _top_structure_keys(seed_rows: List[Tuple], k: int) -> List[Tuple]:
+    keys = []
+    for row in sorted(seed_rows, key=lambda row: row[7]):
+        key = tuple(row[1:5])
+        if key not in keys:
+            keys.append(key)
+            if len(keys) == k:
+                break
+    return keys
+
+
+## @brief 複数のクエリベクトルをまとめて検索し、クエリごとのコンテキストを返す
+def retrieve_chunks_for_rag_batch(
+    db: sqlite3.Connection,
+    query_vectors: Union[np.ndarray, List[List[float]]],
+    k: int,
+    cache: Optional[QueryCache] = None,
+    modalities: Iterable[str] = DEFAULT_MODALITIES
+) -> List[str]:
+    """
+    (クエリ数, 次元数) のクエリ行列について、retrieve_chunks_for_rag と同じルールでコンテキストを取得します。
+    - シード検索は同一のSQL文を繰り返し実行するため、準備済みステートメントが再利用されます。
+    - 全クエリを1つの読み取りトランザクション (同一スナップショット) 内で実行します。
+    - 構造拡張 (構造キーを持つ全TEXTチャンクの取得) は、全クエリの構造キーの和集合に対して1回だけ行います。
+    TEXTチャンクは構造キーの距離順 (同じ構造内はID順)、その他のモダリティはモダリティ順・シードの距離順に並べます。
+    cache を指定すると、キャッシュに無いクエリだけを検索します。
+    """
+    modalities = normalize_modalities(modalities)
+    matrix = np.asarray(query_vectors, dtype="<f4")
+    if matrix.ndim == 1:
+        matrix = matrix[np.newaxis, :]
+
+    contexts = [None] * len(matrix)
+    per_query = [] # (クエリの位置, キャッシュキー, 構造キー, TEXT以外のシード)
+    started_transaction = not db.in_transaction
+    if started_transaction:
+        db.execute("BEGIN")
+    try:
+        generation = get_generation(db) if cache is not None else None
+        storage, int8_scale = get_storage(db)
+        seed_query = SEED_QUERIES[storage]
+        # ステップ1: クエリごとにシードを取得し、上位N件の構造キーを特定
+        for index, query_blob in enumerate(serialize_matrix_rows(matrix)):
+            cache_key = None
+            if cache is not None:
+                cache_key = QueryCache.make_key(query_blob, k, modalities)
+                contexts[index] = cache.get(cache_key, generation)
+                if contexts[index] is not None:
+                    continue
+            params = _seed_params(storage, int8_scale, query_blob, k)
+            # モダリティごとに、vec0 の該当パーティションだけを検索する
+            seeds = [row for modality in modalities for row in db.execute(seed_query, dict(params, type=modality))]
+            seed_others = [row for row in seeds if row[5] != EXPANDED_MODALITY]
+            per_query.append((index, cache_key, _top_structure_keys(seeds, k), seed_others))
+
+        # ステップ2a: 全クエリの構造キーの和集合について、TEXTチャンクを1回で取得
+        text_chunks_by_key = _fetch_text_chunks_by_key(db, (key for _, _, keys, _ in per_query for key in keys), modalities)
+    finally:
+        if started_transaction:
+            db.commit()
+
+    for index, cache_key, keys, seed_others in per_query:
+        contexts[index] = _assemble_context(keys, seed_others, text_chunks_by_key)
+        if cache is not None:
+            cache.put(cache_key, generation, contexts[index])
+    return contexts
+
+
+## @brief 構造キーの和集合について、EXPANDED_MODALITY (TEXT) のチャンクを1回のクエリで取得する (ステップ2a)
+def _fetch_text_chunks_by_key(
+    db: sqlite3.Connection,
+    structure_keys: Iterable[Tuple],
+    modalities: Tuple[str, ...]
+) -> Dict[Tuple, List[Tuple]]:
+    all_keys = list(dict.fromkeys(structure_keys))
+    text_chunks_by_key = defaultdict(list)
+    if all_keys and EXPANDED_MODALITY in modalities:
+        for row in db.execute(EXPANSION_QUERY, {'structure_keys': json.dumps(all_keys)}):
+            text_chunks_by_key[tuple(row[1:5])].append(row)
+    return text_chunks_by_key
+
+
+## @brief 1クエリの構造キーとシードから、最終コンテキストを組み立てる (ステップ2b)
+def _assemble_context(keys: List[Tuple], seed_others: List[Tuple], text_chunks_by_key: Dict[Tuple, List[Tuple]]) -> str:
+    # TEXT以外のチャンクはシードのうち、特定された構造キーを持つものに限定
+    key_set = set(keys)
+    text_chunks = [row for key in keys for row in sorted(text_chunks_by_key[key], key=lambda row: row[0])]
+    other_chunks = [tuple(row[:7]) for row in seed_others if tuple(row[1:5]) in key_set]
+    return format_context(text_chunks + other_chunks)
+
+
+## @brief シード検索 (量子化モードでは再ランキング後) の、float32 の全件走査に対する再現率を計測する
+def measure_seed_recall(
+    db: sqlite3.Connection,
+    query_vectors: Union[np.ndarray, List[List[float]]],
+    k: int,
+    modalities: Iterable[str] = DEFAULT_MODALITIES
+) -> Dict[str, object]:
+    """
+    クエリごと・typeごとに、検索で得たシードN件のうち厳密な上位N件に含まれる割合を平均します。
+    格納形式と、vec0の埋め込み1件あたりのバイト数 (float32 に対する圧縮率) も併せて返します。
+    """
+    storage, int8_scale = get_storage(db)
+    seed_query = SEED_QUERIES[storage]
+    exact_query = build_exact_seed_query(storage)
+    vec_dim = get_vec_dim(db)
+    recalls = {modality: [] for modality in normalize_modalities(modalities)}
+    for query_blob in serialize_matrix_rows(np.asarray(query_vectors, dtype="<f4")):
+        params = _seed_params(storage, int8_scale, query_blob, k)
+        for chunk_type, type_recalls in recalls.items():
+            exact_ids = {row[0] for row in db.execute(exact_query, {'query_embed': query_blob, 'top_k': k, 'type': chunk_type})}
+            if not exact_ids:
+                continue
+            found_ids = {row[0] for row in db.execute(seed_query, dict(params, type=chunk_type))}
+            type_recalls.append(len(found_ids & exact_ids) / len(exact_ids))
+
+    all_recalls = [recall for values in recalls.values() for recall in values]
+    report = {
+        'storage': storage,
+        'queries': len(query_vectors),
+        'k': k,
+        'recall': float(np.mean(all_recalls)) if all_recalls else None,
+        'recall_by_type': {chunk_type: float(np.mean(values)) if values else None for chunk_type, values in recalls.items()},
+    }
+    if vec_dim is not None:
+        report['bytes_per_vector'] = embedding_bytes(vec_dim, storage)
+        report['compression'] = embedding_bytes(vec_dim, STORAGE_FLOAT32) / report['bytes_per_vector']
+    return report
+
+
+# =============================================================================
+# --- フラット厳密検索エンジン ---
+# =============================================================================
+
+## @brief データベースの float32 埋め込みを、フラット検索用の .npy ファイル群に書き出す
+def export_flat_index(db: sqlite3.Connection, index_dir: str) -> "FlatIndex":
+    """
+    行を (type, id) 順に並べ、type ごとに連続した行範囲 (パーティション) にします。
+    埋め込みは np.lib.format.open_memmap に FLAT_EXPORT_BATCH 行ずつ書き込むため、全体をメモリに載せません。
+    書き出した時点のデータの世代番号を manifest に記録し、検索時に古いインデックスを検出します。
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    started_transaction = not db.in_transaction
+    if started_transaction:
+        db.execute("BEGIN")
+    try:
+        storage, _ = get_storage(db)
+        vectors_table = VEC_TABLE if storage == STORAGE_FLOAT32 else FLOAT_VECTORS_TABLE
+        id_rows = db.execute(f"SELECT id, type FROM {CHUNKS_TABLE} ORDER BY type, id;").fetchall()
+        dim_row = db.execute(f"SELECT vec_length(embedding) FROM {VEC_TABLE} LIMIT 1;").fetchone()
+        dim = dim_row[0] if dim_row else 0
+        ids = np.array([row[0] for row in id_rows], dtype=np.int64)
+        partitions = {}
+        for position, (_, chunk_type) in enumerate(id_rows):
+            partitions.setdefault(chunk_type, [position, position])[1] = position + 1
+
+        embeddings = np.lib.format.open_memmap(
+            os.path.join(index_dir, FLAT_EMBEDDINGS_FILE), mode="w+", dtype=np.float32, shape=(len(ids), dim))
+        vectors_sql = f"""
+            SELECT V.embedding
+            FROM json_each(:chunk_ids) AS J
+            JOIN {vectors_table} AS V ON V.id = J.value
+            ORDER BY J.key;
+        """
+        for start in range(0, len(ids), FLAT_EXPORT_BATCH):
+            batch_ids = ids[start:start + FLAT_EXPORT_BATCH]
+            blobs = [row[0] for row in db.execute(vectors_sql, {'chunk_ids': json.dumps(batch_ids.tolist())})]
+            if len(blobs) != len(batch_ids):
+                raise ValueError(f"埋め込みの無いチャンクがあります ({start} 行目以降)。")
+            embeddings[start:start + len(blobs)] = np.frombuffer(b"".join(blobs), dtype="<f4").reshape(len(blobs), dim)
+        generation = get_generation(db)
+    finally:
+        if started_transaction:
+            db.commit()
+
+    embeddings.flush()
+    np.save(os.path.join(index_dir, FLAT_IDS_FILE), ids)
+    np.save(os.path.join(index_dir, FLAT_NORMS_FILE), np.einsum("ij,ij->i", embeddings, embeddings).astype(np.float32))
+    del embeddings
+    with open(os.path.join(index_dir, FLAT_MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump({"dim": dim, "count": len(ids), "generation": generation, "partitions": partitions}, f)
+    return FlatIndex(index_dir)
+
+
+## @brief メモリマップした .npy の埋め込みに対する厳密なKNN
+class FlatIndex:
+    """
+    埋め込み・ID・二乗ノルムは mmap_mode="r" で開くため、読み込みの待ち時間が無く、
+    同じファイルを開いた複数のプロセスでOSのページキャッシュを共有します。
+    search() は type のパーティションだけを FLAT_BLOCK_ROWS 行ずつ行列積 (BLAS) で走査し、
+    argpartition で上位k件を保持します。
+    """
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, FLAT_MANIFEST_FILE), encoding="utf-8") as f:
+            manifest = json.load(f)
+        self.dim = manifest["dim"]
+        self.generation = manifest["generation"]
+        self.partitions = {chunk_type: tuple(bounds) for chunk_type, bounds in manifest["partitions"].items()}
+        self.embeddings = np.load(os.path.join(index_dir, FLAT_EMBEDDINGS_FILE), mmap_mode="r")
+        self.ids = np.load(os.path.join(index_dir, FLAT_IDS_FILE), mmap_mode="r")
+        self.norms = np.load(os.path.join(index_dir, FLAT_NORMS_FILE), mmap_mode="r")
+
+    def search(self, queries: np.ndarray, chunk_type: str, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (クエリ数, 次元数) のクエリについて、chunk_type のチャンクから距離の小さい k 件を返します。
+        戻り値: (チャンクIDの配列 (クエリ数, k), L2距離の配列 (クエリ数, k))。距離の昇順 (同距離はID順)。
+        行列積の展開 |e|^2 - 2 q.e による候補を 2k 件残し、最後に差分から距離を計算し直して k 件に絞ります。
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        start, end = self.partitions.get(chunk_type, (0, 0))
+        keep = min(2 * k, end - start)
+        result_ids = np.empty((len(queries), min(k, end - start)), dtype=np.int64)
+        result_distances = np.empty(result_ids.shape, dtype=np.float32)
+        if keep == 0:
+            return result_ids, result_distances
+
+        for query_start in range(0, len(queries), FLAT_QUERY_BATCH):
+            query_block = queries[query_start:query_start + FLAT_QUERY_BATCH]
+            best_rows = np.empty((len(query_block), 0), dtype=np.int64)
+            best_scores = np.empty((len(query_block), 0), dtype=np.float32)
+            for block_start in range(start, end, FLAT_BLOCK_ROWS):
+                block_end = min(block_start + FLAT_BLOCK_ROWS, end)
+                # |q - e|^2 の順位は |e|^2 - 2 q.e で決まる (|q|^2 はクエリごとに一定)
+                scores = query_block @ self.embeddings[block_start:block_end].T
+                scores *= -2.0
+                scores += self.norms[block_start:block_end]
+                # ブロック内の上位だけを行番号に直してから前回の候補と併合する (ブロック全体の行番号の行列は作らない)
+                block_keep = min(keep, block_end - block_start)
+                # 添字はコピーして、ブロック全体の添字配列を次のブロックまで保持しない
+                part = np.argpartition(scores, block_keep - 1, axis=1)[:, :block_keep].copy()
+                rows = np.concatenate([best_rows, part + block_start], axis=1)
+                scores = np.concatenate([best_scores, np.take_along_axis(scores, part, axis=1)], axis=1)
+                if rows.shape[1] > keep:
+                    part = np.argpartition(scores, keep - 1, axis=1)[:, :keep]
+                    rows = np.take_along_axis(rows, part, axis=1)
+                    scores = np.take_along_axis(scores, part, axis=1)
+                best_rows, best_scores = rows, scores
+
+            # 候補について差分から距離を計算し直し、距離順 (同距離はID順) に k 件を選ぶ
+            candidate_ids = self.ids[best_rows]
+            distances = np.linalg.norm(self.embeddings[best_rows] - query_block[:, np.newaxis, :], axis=2)
+            order = np.lexsort((candidate_ids, distances), axis=1)[:, :result_ids.shape[1]]
+            result_ids[query_start:query_start + len(query_block)] = np.take_along_axis(candidate_ids, order, axis=1)
+            result_distances[query_start:query_start + len(query_block)] = np.take_along_axis(distances, order, axis=1)
+        return result_ids, result_distances
+
+
+## @brief フラット厳密検索エンジンで、retrieve_chunks_for_rag_batch と同じルールのコンテキストを取得する
+def retrieve_chunks_for_rag_flat(
+    db: sqlite3.Connection,
+    flat_index: FlatIndex,
+    query_vectors: Union[np.ndarray, List[List[float]]],
+    k: int,
+    cache: Optional[QueryCache] = None,
+    modalities: Iterable[str] = DEFAULT_MODALITIES
+) -> List[str]:
+    """
+    シード検索 (ステップ1) を flat_index の行列積で全クエリまとめて行い、
+    シードのメタデータ取得と構造拡張 (ステップ2) はSQLiteのチャンクテーブルに対して行います。
+    インデックスの世代番号がデータベースと異なる (書き出し後に挿入・削除があった) 場合は ValueError を送出します。
+    """
+    modalities = normalize_modalities(modalities)
+    matrix = np.asarray(query_vectors, dtype="<f4")
+    if matrix.ndim == 1:
+        matrix = matrix[np.newaxis, :]
+
+    contexts = [None] * len(matrix)
+    started_transaction = not db.in_transaction
+    if started_transaction:
+        db.execute("BEGIN")
+    try:
+        generation = get_generation(db)
+        if flat_index.generation != generation:
+            raise ValueError(f"フラットインデックス (世代 {flat_index.generation}) がデータベース (世代 {generation}) と一致しないため、"
+                             "export_flat_index で書き出し直す必要があります。")
+        cache_keys = [None] * len(matrix)
+        if cache is not None:
+            for index, query_blob in enumerate(serialize_matrix_rows(matrix)):
+                cache_keys[index] = QueryCache.make_key(query_blob, k, modalities)
+                contexts[index] = cache.get(cache_keys[index], generation)
+        misses = [index for index, context in enumerate(contexts) if context is None]
+
+        # ステップ1: モダリティごとに、全クエリのシードを行列積でまとめて取得
+        seeds_by_modality = [flat_index.search(matrix[misses], modality, k) for modality in modalities]
+        seed_ids = {int(chunk_id) for ids, _ in seeds_by_modality for chunk_id in ids.ravel()}
+        chunk_rows = {row[0]: row for row in db.execute(CHUNKS_BY_ID_QUERY, {'chunk_ids': json.dumps(sorted(seed_ids))})}
+
+        per_query = []
+        for position, index in enumerate(misses):
+            seeds = [chunk_rows[int(chunk_id)] + (float(distance),)
+                     for ids, distances in seeds_by_modality
+                     for chunk_id, distance in zip(ids[position], distances[position])]
+            seed_others = [row for row in seeds if row[5] != EXPANDED_MODALITY]
+            per_query.append((index, _top_structure_keys(seeds, k), seed_others))
+
+        # ステップ2a: 全クエリの構造キーの和集合について、TEXTチャンクを1回で取得
+        text_chunks_by_key = _fetch_text_chunks_by_key(db, (key for _, keys, _ in per_query for key in keys), modalities)
+    finally:
+        if started_transaction:
+            db.commit()
+
+    for index, keys, seed_others in per_query:
+        contexts[index] = _assemble_context(keys, seed_others, text_chunks_by_key)
+        if cache is not None:
+            cache.put(cache_keys[index], generation, contexts[index])
+    return contexts
+
+
 # =============================================================================
 # --- メイン実行ブロック ---
 # =============================================================================
@@ -0,0 +1,413 @@
+import argparse
+import datetime
+import functools
+import itertools
+import json
+import os
+import platform
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+import sqlite_vec
+
+import rag
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+# =========================================================================
+# rag.py の検索のベンチマークと再現率の検証
+# 合成コーパス (次元数、構造グループの大きさ、IMAGE の割合を指定) を生成して投入し、
+# 投入速度 / クエリ遅延 (p50, p99) / メモリ / NumPy の全件走査による厳密解に対する再現率 を計測して、
+# 格納形式 (float32 / int8 / bit) と検索エンジンの組ごとに JSON に書き出す。
+# =========================================================================
+
+BENCH_FORMAT_VERSION = 2
+DEFAULT_SIZES = [100000]
+DEFAULT_DIM = 128
+DEFAULT_GROUP_SIZE = 8 # 1つの構造 (filename, chapter, section, item) に属するチャンク数
+DEFAULT_IMAGE_RATIO = 0.3
+DEFAULT_QUERIES = 200
+DEFAULT_WARMUP_QUERIES = 10
+GROUP_SPREAD = 0.35 # 構造グループ内のばらつき (グループ中心に加えるノイズの大きさ)
+QUERY_NOISE = 0.1 # クエリ = コーパス中のベクトル + このノイズ
+BLOCK_ROWS = 1 << 16 # コーパスを生成・投入・走査するブロックの行数 (目安)
+CHUNK_TYPES = ("TEXT", "IMAGE")
+# 比較モードで回帰とみなす比率 (遅延は増加、投入速度と再現率は減少)
+DEFAULT_REGRESSION_THRESHOLD = 1.10
+# 比較モードで一致している必要がある計測条件 (異なる条件の結果どうしは比較しない)
+COMPARABLE_CONFIG_KEYS = ("dim", "k", "group_size", "image_ratio", "queries", "seed")
+# これより短い遅延・投入時間は計測誤差が大きいため比較しない
+MIN_COMPARABLE_MS = 1.0
+MIN_COMPARABLE_SECONDS = 0.005
+
+# 検索エンジン: (db, データベースのパス) -> 検索関数 (クエリ行列, k) -> コンテキストのリスト
+ENGINES = {
+    # 単一SQLクエリ (retrieve_chunks_for_rag)。表示はしない
+    "sql": lambda db, db_path: lambda queries, k: [rag.retrieve_chunks_for_rag(db, query.tolist(), k, verbose=False) for query in queries],
+    # バッチ検索 (1クエリずつ呼び出して遅延を計測する)
+    "batch": lambda db, db_path: lambda queries, k: rag.retrieve_chunks_for_rag_batch(db, queries, k),
+    # フラット厳密検索 (データベースの隣に .npy を書き出してから計測する)
+    "flat": lambda db, db_path: functools.partial(
+        rag.retrieve_chunks_for_rag_flat, db, rag.export_flat_index(db, db_path + ".flat")),
+}
+CONTEXT_ID_PATTERN = re.compile(r"\[ID:(\d+) \|")
+
+
+# =========================================================================
+# --- 合成コーパス ---
+# チャンク i は構造グループ i // group_size に属する。各ブロックは (seed, ブロック番号) から決定的に生成するため、
+# 厳密解の計算ではコーパス全体をメモリに載せずにブロックごとに再生成できる。
+# =========================================================================
+
+def _block_rows(group_size):
+    """グループがブロックをまたがないよう、BLOCK_ROWS を group_size の倍数に丸めた値"""
+    return max(BLOCK_ROWS // group_size, 1) * group_size
+
+
+def structure_key(group):
+    """構造グループ番号から (filename, chapter, section, item) を作る"""
+    return (f"doc{group // 1000}", str(group // 100 % 10), str(group // 10 % 10), str(group % 10))
+
+
+def iter_corpus_blocks(num_chunks, dim, group_size, image_ratio, seed=0):
+    """
+    (先頭のID, 埋め込み (行数, dim) の float32 正規化済み行列, type コードの配列) をブロックごとに返す。
+    type コードは CHUNK_TYPES の添字。埋め込みはグループ中心 + ノイズなので、同じ構造のチャンクは近い。
+    """
+    block_rows = _block_rows(group_size)
+    for block_index, start in enumerate(range(0, num_chunks, block_rows)):
+        rows = min(block_rows, num_chunks - start)
+        rng = np.random.default_rng([seed, block_index])
+        groups = -(-rows // group_size)
+        centers = rng.standard_normal((groups, dim), dtype=np.float32)
+        embeddings = np.repeat(centers, group_size, axis=0)[:rows]
+        embeddings += GROUP_SPREAD * rng.standard_normal((rows, dim), dtype=np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        type_codes = (rng.random(rows) < image_ratio).astype(np.uint8)
+        yield start, embeddings, type_codes
+
+
+def _metadata_rows(start, type_codes, group_size):
+    for offset, code in enumerate(type_codes):
+        chunk_id = start + offset
+        chunk_type = CHUNK_TYPES[code]
+        yield (chunk_id, *structure_key(chunk_id // group_size), chunk_type, f"{chunk_type.lower()} chunk {chunk_id}")
+
+
+# =========================================================================
+# --- 厳密解 (NumPy の全件走査) ---
+# =========================================================================
+
+def exact_seeds(queries, k, blocks):
+    """
+    type ごとに、全件走査でクエリに最も近い k 件の (ID, 距離) を求める。
+    戻り値: {type コード: (ID の配列 (クエリ数, k), 距離の配列 (クエリ数, k))} (距離の昇順)
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    query_norms = np.einsum("ij,ij->i", queries, queries)[:, np.newaxis]
+    best = {code: (np.empty((len(queries), 0), dtype=np.int64), np.empty((len(queries), 0), dtype=np.float32))
+            for code in range(len(CHUNK_TYPES))}
+    for start, embeddings, type_codes in blocks:
+        # |q - e|^2 = |q|^2 - 2 q.e + |e|^2
+        distances = query_norms - 2.0 * (queries @ embeddings.T) + np.einsum("ij,ij->i", embeddings, embeddings)
+        for code in best:
+            columns = np.flatnonzero(type_codes == code)
+            if len(columns) == 0:
+                continue
+            # ブロック内の上位だけをIDに直してから前回の候補と併合する (ブロック全体のIDの行列は作らない)
+            block_dists = distances[:, columns]
+            block_keep = min(k, len(columns))
+            # 添字はコピーして、ブロック全体の添字配列を次のブロックまで保持しない
+            part = np.argpartition(block_dists, block_keep - 1, axis=1)[:, :block_keep].copy()
+            ids = np.concatenate([best[code][0], start + columns[part]], axis=1)
+            dists = np.concatenate([best[code][1], np.take_along_axis(block_dists, part, axis=1)], axis=1)
+            if ids.shape[1] > k:
+                part = np.argpartition(dists, k - 1, axis=1)[:, :k]
+                ids = np.take_along_axis(ids, part, axis=1)
+                dists = np.take_along_axis(dists, part, axis=1)
+            best[code] = (ids, dists)
+    for code, (ids, dists) in best.items():
+        order = np.lexsort((ids, dists), axis=1)
+        best[code] = (np.take_along_axis(ids, order, axis=1), np.sqrt(np.maximum(np.take_along_axis(dists, order, axis=1), 0.0)))
+    return best
+
+
+def expected_chunk_ids(seeds, query_index, k, group_size, all_type_codes):
+    """rag.py の検索ルールを厳密なシードに適用し、返るべきチャンクIDの集合を求める"""
+    seed_list = sorted((float(dist), int(chunk_id), code)
+                       for code, (ids, dists) in seeds.items()
+                       for chunk_id, dist in zip(ids[query_index], dists[query_index]))
+    top_groups = list(dict.fromkeys(chunk_id // group_size for _, chunk_id, _ in seed_list))[:k]
+    expected = set()
+    text_code = CHUNK_TYPES.index(rag.EXPANDED_MODALITY)
+    for group in top_groups:
+        members = np.arange(group * group_size, min((group + 1) * group_size, len(all_type_codes)))
+        expected.update(int(chunk_id) for chunk_id in members[all_type_codes[members] == text_code])
+    expected.update(chunk_id for _, chunk_id, code in seed_list
+                    if code != text_code and chunk_id // group_size in top_groups)
+    return expected
+
+
+# =========================================================================
+# --- 計測 ---
+# =========================================================================
+
+def open_database(path):
+    db = sqlite3.connect(path)
+    db.enable_load_extension(True)
+    sqlite_vec.load(db)
+    db.enable_load_extension(False)
+    return db
+
+
+def _database_bytes(path):
+    return sum(os.path.getsize(path + suffix) for suffix in ("", "-wal", "-shm") if os.path.exists(path + suffix))
+
+
+def _process_peak_rss_bytes():
+    """
+    プロセス開始からのピーク RSS (SQLite のページキャッシュも含む)。計測点ごとの値ではなく、
+    それまでに計測した全ての点の最大値になる。取得できない環境では None。
+    """
+    if resource is not None:
+        # ru_maxrss は Linux では KiB 単位、macOS ではバイト単位
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == "darwin" else max_rss * 1024
+    try:
+        import psutil
+    except ImportError:
+        return None
+    # Windows: ピークのワーキングセット
+    return getattr(psutil.Process().memory_info(), "peak_wset", None)
+
+
+def measure_point(db_path, num_chunks, dim, group_size, image_ratio, storage, engines, num_queries, k, seed=0, log=print):
+    """1つのコーパスサイズ・格納形式について、投入と各エンジンの検索を計測する"""
+    def corpus():
+        return iter_corpus_blocks(num_chunks, dim, group_size, image_ratio, seed)
+
+    # クエリの元にするチャンクを選んでおき、投入中のブロックから取り出す
+    rng = np.random.default_rng([seed, num_chunks])
+    query_sources = np.sort(rng.choice(num_chunks, size=min(num_queries, num_chunks), replace=False))
+    source_rows = []
+    all_type_codes = np.empty(num_chunks, dtype=np.uint8)
+
+    def ingest_blocks():
+        for start, embeddings, type_codes in corpus():
+            all_type_codes[start:start + len(type_codes)] = type_codes
+            picked = query_sources[(query_sources >= start) & (query_sources < start + len(type_codes))]
+            source_rows.append(embeddings[picked - start])
+            yield start, embeddings, type_codes
+
+    db = open_database(db_path)
+    try:
+        rag.create_schema(db, dim, storage)
+        # ブロックは1回だけ生成し、メタデータと埋め込みの両方に使う (bulk_insert_chunks は両者を同じ速さで消費する)
+        metadata_blocks, embedding_blocks = itertools.tee(ingest_blocks())
+        start_time = time.perf_counter()
+        inserted = rag.bulk_insert_chunks(
+            db,
+            (row for start, _, type_codes in metadata_blocks for row in _metadata_rows(start, type_codes, group_size)),
+            (embeddings for _, embeddings, _ in embedding_blocks),
+            dim
+        )
+        ingest_seconds = time.perf_counter() - start_time
+        ingest = {
+            "rows": inserted,
+            "seconds": ingest_seconds,
+            "rows_per_second": inserted / ingest_seconds if ingest_seconds else None,
+            "db_bytes": _database_bytes(db_path),
+        }
+        log(f"  ingest: {inserted} rows in {ingest_seconds:.2f}s ({ingest['rows_per_second']:.0f} rows/s), "
+            f"db={ingest['db_bytes'] / 2**20:.1f}MiB")
+
+        sources = np.concatenate(source_rows)
+        queries = sources + QUERY_NOISE * rng.standard_normal(sources.shape, dtype=np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+        reference_start = time.perf_counter()
+        seeds = exact_seeds(queries, k, corpus())
+        expected = [expected_chunk_ids(seeds, index, k, group_size, all_type_codes) for index in range(len(queries))]
+        reference_seconds = time.perf_counter() - reference_start
+
+        results = {}
+        for engine in engines:
+            prepare_start = time.perf_counter()
+            run = ENGINES[engine](db, db_path)
+            prepare_seconds = time.perf_counter() - prepare_start
+            for query in queries[:DEFAULT_WARMUP_QUERIES]:
+                run(query[np.newaxis, :], k)
+            latencies = []
+            recalls = []
+            exact_matches = 0
+            for query, expected_ids in zip(queries, expected):
+                start_time = time.perf_counter()
+                context = run(query[np.newaxis, :], k)[0]
+                latencies.append(time.perf_counter() - start_time)
+                got_ids = {int(chunk_id) for chunk_id in CONTEXT_ID_PATTERN.findall(context)}
+                recalls.append(len(got_ids & expected_ids) / len(expected_ids) if expected_ids else 1.0)
+                exact_matches += got_ids == expected_ids
+            latencies = np.array(latencies)
+            results[engine] = {
+                "prepare_seconds": prepare_seconds,
+                "p50_ms": float(np.percentile(latencies, 50) * 1000),
+                "p99_ms": float(np.percentile(latencies, 99) * 1000),
+                "mean_ms": float(latencies.mean() * 1000),
+                "recall": float(np.mean(recalls)),
+                "exact_match_rate": exact_matches / len(queries),
+            }
+            r = results[engine]
+            log(f"  {engine:<6} p50={r['p50_ms']:.2f}ms p99={r['p99_ms']:.2f}ms recall={r['recall']:.4f} "
+                f"exact={r['exact_match_rate']:.3f}")
+    finally:
+        db.close()
+
+    return {
+        "chunks": num_chunks,
+        "storage": storage,
+        "queries": len(queries),
+        "ingest": ingest,
+        "reference_seconds": reference_seconds,
+        "engines": results,
+        "process_peak_rss_bytes": _process_peak_rss_bytes(),
+    }
+
+
+
+def run_benchmark(sizes, dim, group_size, image_ratio, storages, engines, num_queries, k, db_dir=None, seed=0, log=print):
+    """コーパスサイズと格納形式の組ごとに計測し、JSON に書き出せる辞書を返す"""
+    work_dir = db_dir or tempfile.mkdtemp(prefix="rag_bench_")
+    results = []
+    try:
+        for num_chunks in sizes:
+            for storage in storages:
+                db_path = os.path.join(work_dir, f"rag_bench_{num_chunks}_{storage}.sqlite")
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(db_path + suffix):
+                        os.remove(db_path + suffix)
+                log(f"chunks={num_chunks} dim={dim} storage={storage}")
+                results.append(measure_point(db_path, num_chunks, dim, group_size, image_ratio, storage,
+                                             engines, num_queries, k, seed, log))
+    finally:
+        if db_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        "version": BENCH_FORMAT_VERSION,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "sqlite": sqlite3.sqlite_version,
+        "dim": dim,
+        "group_size": group_size,
+        "image_ratio": image_ratio,
+        "k": k,
+        "queries": num_queries,
+        "seed": seed,
+        "results": results,
+    }
+
+
+def compare_results(current, baseline, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    """
+    baseline と比較し、(チャンク数, 格納形式, エンジン, 指標) ごとの比較結果のリストを返す。
+    各要素: {"chunks", "storage", "engine", "metric", "baseline", "current", "ratio", "status"}
+    遅延 (p50_ms, p99_ms) は増加、投入速度 (rows_per_second) と再現率 (recall) は減少を回帰とみなす。
+    status は "regression" / "improvement" / "same" / "skipped" (遅延が MIN_COMPARABLE_MS 未満、
+    または投入時間が MIN_COMPARABLE_SECONDS 未満で、比較しない)
+    計測条件 (COMPARABLE_CONFIG_KEYS) が異なる結果どうしは比較できないため ValueError を送出する。
+    """
+    mismatched = [f"{key}: baseline={baseline.get(key)!r}, current={current.get(key)!r}"
+                  for key in COMPARABLE_CONFIG_KEYS if baseline.get(key) != current.get(key)]
+    if mismatched:
+        raise ValueError(f"計測条件が異なるため比較できません ({'; '.join(mismatched)})")
+    baseline_points = {(point["chunks"], point["storage"]): point for point in baseline["results"]}
+    comparisons = []
+
+    def add(point, engine, metric, base_value, current_value, higher_is_better, comparable=True):
+        if not base_value or current_value is None:
+            return
+        if not comparable:
+            ratio, status = None, "skipped"
+        else:
+            ratio = current_value / base_value
+            worse, better = (ratio < 1 / threshold, ratio > threshold) if higher_is_better else (ratio > threshold, ratio < 1 / threshold)
+            status = "regression" if worse else "improvement" if better else "same"
+        comparisons.append({"chunks": point["chunks"], "storage": point["storage"], "engine": engine, "metric": metric,
+                            "baseline": base_value, "current": current_value, "ratio": ratio, "status": status})
+
+    for point in current["results"]:
+        base_point = baseline_points.get((point["chunks"], point["storage"]))
+        if base_point is None:
+            continue
+        add(point, "ingest", "rows_per_second", base_point["ingest"]["rows_per_second"], point["ingest"]["rows_per_second"], True,
+            max(base_point["ingest"]["seconds"], point["ingest"]["seconds"]) >= MIN_COMPARABLE_SECONDS)
+        for engine, metrics in point["engines"].items():
+            base_metrics = base_point["engines"].get(engine)
+            if base_metrics is None:
+                continue
+            for metric in ("p50_ms", "p99_ms"):
+                add(point, engine, metric, base_metrics[metric], metrics[metric], False,
+                    max(base_metrics[metric], metrics[metric]) >= MIN_COMPARABLE_MS)
+            add(point, engine, "recall", base_metrics["recall"], metrics["recall"], True)
+    return comparisons
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="rag.py の検索のベンチマークと再現率の検証")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="コーパスのチャンク数")
+    parser.add_argument("--dim", type=int, default=DEFAULT_DIM, help="埋め込みの次元数")
+    parser.add_argument("--group-size", type=int, default=DEFAULT_GROUP_SIZE, help="1つの構造に属するチャンク数")
+    parser.add_argument("--image-ratio", type=float, default=DEFAULT_IMAGE_RATIO, help="IMAGE チャンクの割合")
+    parser.add_argument("--storage", nargs="+", default=[rag.STORAGE_FLOAT32], choices=rag.STORAGE_MODES, help="格納形式")
+    parser.add_argument("--engines", nargs="+", default=list(ENGINES), choices=list(ENGINES), help="計測する検索エンジン")
+    parser.add_argument("--queries", type=int, default=DEFAULT_QUERIES, help="クエリ数")
+    parser.add_argument("--k", type=int, default=rag.TOP_K, help="シード数 (TOP_K)")
+    parser.add_argument("--seed", type=int, default=0, help="コーパスとクエリの乱数シード")
+    parser.add_argument("--db-dir", help="データベースを作成するディレクトリ (省略時は一時ディレクトリを作成し、終了後に削除)")
+    parser.add_argument("--output", default="rag_bench.json", help="結果を書き出す JSON ファイル")
+    parser.add_argument("--compare", metavar="BASELINE_JSON", help="過去の結果と比較し、回帰があれば終了コード 1 を返す")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD, help="回帰とみなす比率")
+    args = parser.parse_args(argv)
+
+    # --output と --compare が同じファイルでも比較できるよう、結果を書き出す前に baseline を読み込む
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    current = run_benchmark(args.sizes, args.dim, args.group_size, args.image_ratio, args.storage, args.engines,
+                            args.queries, args.k, args.db_dir, args.seed)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(current, f, indent=2)
+    print(f"💾 結果を {args.output} に書き出しました。")
+
+    if baseline is None:
+        return 0
+
+    try:
+        comparisons = compare_results(current, baseline, args.threshold)
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 2
+    print(f"\n--- {args.compare} との比較 (閾値 x{args.threshold}) ---")
+    for c in comparisons:
+        if c["status"] == "skipped":
+            continue
+        mark = {"regression": "❌", "improvement": "✅", "same": "  "}[c["status"]]
+        print(f"{mark} chunks={c['chunks']} {c['storage']:<7} {c['engine']:<6} {c['metric']:<15} "
+              f"{c['baseline']:12.4f} -> {c['current']:12.4f} (x{c['ratio']:.2f})")
+    regressions = sum(1 for c in comparisons if c["status"] == "regression")
+    print(f"回帰: {regressions} 件")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,316 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import os
+import queue
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import sqlite_vec
+
+import rag
+
+# =========================================================================
+# rag.py の検索を並行リクエストに応答できるようにする非同期検索サービス
+# 読み取り専用接続のプールと、サイズ上限付きのスレッドプールでクエリを実行する。
+# (sqlite3 はクエリ実行中に GIL を解放するため、スレッド数に応じてスループットが伸びる)
+# =========================================================================
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+DEFAULT_MAX_PENDING = 64 # スレッドプールへ投入済み (実行中 + キュー待ち) のリクエスト数の上限
+DEFAULT_TIMEOUT_SECONDS = 5.0 # 1リクエストあたりのタイムアウト (空き待ち + 検索)
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+MAX_REQUEST_BYTES = 1 << 20 # HTTP リクエストボディの上限
+FLOAT32_MAX = 3.4028234663852886e38 # クエリベクトルの成分の絶対値の上限
+
+
+## @brief 空き待ちが上限を超えた (過負荷) ことを表す例外
+class ServiceOverloadedError(RuntimeError):
+    pass
+
+
+## @brief sqlite_vec を読み込んだ読み取り専用の接続を開く
+def open_read_connection(db_path: str) -> sqlite3.Connection:
+    """
+    書き込みは行わないため mode=ro で開き、query_only も有効にします。
+    一括投入 (rag.bulk_insert_chunks) がデータベースを WAL モードにしているため、
+    読み取り接続は書き込み中でもブロックされずに直前のスナップショットを読めます。
+    """
+    db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+    db.enable_load_extension(True)
+    sqlite_vec.load(db)
+    db.enable_load_extension(False)
+    db.execute("PRAGMA query_only = ON;")
+    return db
+
+
+## @brief 読み取り専用接続のプール
+class ReadConnectionPool:
+    """
+    接続は作成時に size 個まとめて開き (sqlite_vec の読み込みも1接続につき1回だけ)、
+    acquire() で貸し出します。1つの接続は同時に1スレッドだけが使います。
+    """
+    def __init__(self, db_path: str, size: int):
+        self.db_path = db_path
+        self.size = size
+        self._idle = queue.Queue()
+        self._connections = []
+        for _ in range(size):
+            db = open_read_connection(db_path)
+            self._connections.append(db)
+            self._idle.put(db)
+
+    @contextlib.contextmanager
+    def acquire(self) -> Iterator[sqlite3.Connection]:
+        db = self._idle.get()
+        try:
+            yield db
+        finally:
+            self._idle.put(db)
+
+    def close(self):
+        for db in self._connections:
+            db.close()
+        self._connections = []
+
+
+## @brief asyncio から使う検索サービス
+class RetrievalService:
+    """
+    retrieve() は rag.retrieve_chunks_for_rag と同じ検索ルールでコンテキストを返すコルーチンです。
+    - 検索はサイズ workers のスレッドプールで実行し、接続も同数をプールします。
+    - スレッドプールへ投入済みのリクエストが max_pending に達している場合は、空きを待ちます。
+      タイムアウトまでに空かなければ ServiceOverloadedError を送出します (バックプレッシャー)。
+    - 検索がタイムアウトした場合は TimeoutError を送出します。実行中のクエリは中断できないため、
+      スレッド側の完了までリクエスト枠は解放されません。
+    """
+    def __init__(
+        self,
+        db_path: str,
+        workers: int = DEFAULT_WORKERS,
+        max_pending: int = DEFAULT_MAX_PENDING,
+        timeout_seconds: Optional[float] = DEFAULT_TIMEOUT_SECONDS,
+        cache: Optional[rag.QueryCache] = None
+    ):
+        self.workers = workers
+        self.max_pending = max(max_pending, workers)
+        self.timeout_seconds = timeout_seconds
+        self.cache = cache
+        self.pool = ReadConnectionPool(db_path, workers)
+        with self.pool.acquire() as db:
+            self.vec_dim = rag.get_vec_dim(db) # クエリベクトルの次元数の検証用 (空のデータベースでは None)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rag-retrieval")
+        self._slots = None # asyncio.Semaphore (イベントループ上で最初の retrieve() 時に作成)
+        self._stats_lock = threading.Lock()
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.failed = 0
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _retrieve_blocking(self, query_vector: List[float], k: int, modalities: Iterable[str]) -> str:
+        with self.pool.acquire() as db:
+            return rag.retrieve_chunks_for_rag_batch(db, [query_vector], k, cache=self.cache, modalities=modalities)[0]
+
+    async def retrieve(
+        self,
+        query_vector: List[float],
+        k: int = rag.TOP_K,
+        modalities: Iterable[str] = rag.DEFAULT_MODALITIES
+    ) -> str:
+        loop = asyncio.get_running_loop()
+        deadline = None if self.timeout_seconds is None else loop.time() + self.timeout_seconds
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), None if deadline is None else max(deadline - loop.time(), 0.0))
+        except asyncio.TimeoutError:
+            self._count("rejected")
+            raise ServiceOverloadedError(f"同時リクエスト数の上限 ({self.max_pending}) に達しています。") from None
+
+        future = loop.run_in_executor(self._executor, self._retrieve_blocking, query_vector, k, modalities)
+        # 枠はタイムアウト時ではなく、スレッド側の検索が終わった時点で解放する
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            remaining = None if deadline is None else max(deadline - loop.time(), 0.0)
+            context = await asyncio.wait_for(asyncio.shield(future), remaining)
+        except asyncio.TimeoutError:
+            self._count("timed_out")
+            raise TimeoutError(f"検索が {self.timeout_seconds} 秒以内に完了しませんでした。") from None
+        except Exception:
+            self._count("failed")
+            raise
+        self._count("completed")
+        return context
+
+    def stats(self) -> Dict[str, object]:
+        with self._stats_lock:
+            stats = {
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "failed": self.failed,
+            }
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.pool.close()
+
+
+# =========================================================================
+# --- ローカル HTTP エンドポイント ---
+# POST /retrieve  {"vector": [...], "k": 2, "modalities": ["TEXT", "IMAGE"]}  ->  {"context": "..."}
+#                 (k と modalities は省略可)
+# GET  /stats                                 ->  サービスの統計
+# =========================================================================
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large",
+                500: "Internal Server Error", 503: "Service Unavailable", 504: "Gateway Timeout"}
+
+
+async def _write_json_response(writer: asyncio.StreamWriter, status: int, payload: Dict[str, object]):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    head = (f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+            f"Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: keep-alive\r\n\r\n")
+    writer.write(head.encode("ascii") + body)
+    await writer.drain()
+
+
+def _parse_retrieve_request(service: RetrievalService, body: bytes):
+    """/retrieve のリクエストボディを検証し、(クエリベクトル, k, モダリティのタプル) を返す (不正なら ValueError)"""
+    request = json.loads(body)
+    if not isinstance(request, dict):
+        raise ValueError("JSON オブジェクトである必要があります。")
+    if "vector" not in request:
+        raise ValueError("vector がありません。")
+    vector = request["vector"]
+    if not isinstance(vector, list):
+        raise ValueError("vector は数値のリストである必要があります。")
+    query_vector = [float(x) for x in vector]
+    # float32 に変換すると無限大になる値も同様に拒否する
+    if not all(math.isfinite(x) and abs(x) <= FLOAT32_MAX for x in query_vector):
+        raise ValueError("vector に NaN、無限大、または float32 の範囲外の値が含まれています。")
+    if service.vec_dim is not None and len(query_vector) != service.vec_dim:
+        raise ValueError(f"vector の次元数 ({len(query_vector)}) がデータベース ({service.vec_dim}) と一致しません。")
+    k = request.get("k", rag.TOP_K)
+    if isinstance(k, bool) or not isinstance(k, int) or k <= 0:
+        raise ValueError(f"k は正の整数である必要があります: {k!r}")
+    modalities = request.get("modalities", list(rag.DEFAULT_MODALITIES))
+    if not isinstance(modalities, list) or not all(isinstance(modality, str) for modality in modalities):
+        raise ValueError("modalities は文字列のリストである必要があります。")
+    return query_vector, k, rag.normalize_modalities(modalities)
+
+
+async def _handle_request(service: RetrievalService, method: str, path: str, body: bytes):
+    """(ステータスコード, レスポンスの辞書) を返す"""
+    if method == "GET" and path == "/stats":
+        return 200, service.stats()
+    if method != "POST" or path != "/retrieve":
+        return 404, {"error": f"{method} {path} は存在しません。"}
+    try:
+        query_vector, k, modalities = _parse_retrieve_request(service, body)
+    except (ValueError, TypeError) as e:
+        return 400, {"error": f"リクエストの形式が不正です: {e}"}
+    try:
+        return 200, {"context": await service.retrieve(query_vector, k, modalities)}
+    except ServiceOverloadedError as e:
+        return 503, {"error": str(e)}
+    except TimeoutError as e:
+        return 504, {"error": str(e)}
+    except sqlite3.Error as e:
+        return 500, {"error": f"データベース操作エラー: {e}"}
+    except Exception as e:
+        return 500, {"error": f"内部エラー: {type(e).__name__}: {e}"}
+
+
+async def _serve_connection(service: RetrievalService, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """1つの TCP 接続上の HTTP/1.1 リクエストを順に処理する (keep-alive 対応)"""
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            try:
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            except ValueError:
+                await _write_json_response(writer, 400, {"error": "リクエスト行の形式が不正です。"})
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            try:
+                length = int(headers.get("content-length", 0))
+            except ValueError:
+                length = -1
+            if length < 0:
+                await _write_json_response(writer, 400, {"error": "Content-Length が不正です。"})
+                break
+            if length > MAX_REQUEST_BYTES:
+                await _write_json_response(writer, 413, {"error": f"リクエストが {MAX_REQUEST_BYTES} バイトを超えています。"})
+                break
+            body = await reader.readexactly(length) if length else b""
+            status, payload = await _handle_request(service, method, path, body)
+            await _write_json_response(writer, status, payload)
+            if headers.get("connection", "").lower() == "close":
+                break
+    except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_http(service: RetrievalService, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+    server = await asyncio.start_server(lambda r, w: _serve_connection(service, r, w), host, port)
+    print(f"🚀 検索サービスを http://{host}:{port} で開始しました (workers={service.workers}, max_pending={service.max_pending})。")
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="rag.py の検索をローカル HTTP で提供するサービス")
+    parser.add_argument("--db", default=rag.DB_PATH, help="検索対象のデータベースファイル")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="検索スレッド数 (= 読み取り接続数)")
+    parser.add_argument("--max-pending", type=int, default=DEFAULT_MAX_PENDING, help="実行中 + 待機中のリクエスト数の上限")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT_SECONDS, help="1リクエストあたりのタイムアウト (秒)")
+    parser.add_argument("--no-cache", action="store_true", help="クエリ結果キャッシュを使わない")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        print(f"❌ データベースファイル {args.db} が見つかりません。")
+        return 1
+    cache = None if args.no_cache else rag.QueryCache()
+    service = RetrievalService(args.db, args.workers, args.max_pending, args.timeout, cache)
+    try:
+        asyncio.run(serve_http(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+        print("検索サービスを停止しました。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())